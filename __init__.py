@@ -1,11 +1,26 @@
 from distutils.util import strtobool
+import os
 import re
+import time
+import pipes
+import hashlib
+import fnmatch
+import ast
+import json
+import multiprocessing
+import subprocess
+import shutil
+import socket
+from contextlib import contextmanager
 from functools import wraps
-from fabric.api import env, local, abort, sudo, cd, run, task
+from fabric.api import env, local, abort, sudo, cd, run, task, execute, settings, hide
 from fabric.colors import green, red, blue, cyan, yellow, magenta
 from fabric.context_managers import prefix
 from fabric.decorators import hosts, with_settings
-from fabric.contrib.files import exists
+from fabric.contrib.project import rsync_project
+from fabric.network import normalize
+from fabric.operations import _AttributeString, _prefix_commands, _prefix_env_vars, _shell_wrap
+from fabric.state import output, connections
 from pprint import pprint
 
 ## Example settings
@@ -49,6 +64,79 @@ DEFAULT_SETTINGS = dict(
     BOUNCE_SERVICES_ONLY_IF_RUNNING=False,
     OS_SERVICE_MANAGER='upstart',
     REQUIRE_REMOTE_CLEAN=True,
+    PARALLEL_POOL_SIZE=5,
+    FAIL_FAST=False,
+    BATCH_REMOTE_COMMANDS=False,
+    REQUIREMENTS_FILES=['requirements.txt'],
+    FORCE_REQUIREMENTS=False,
+    SURGE_STATE_DIR='.git/surge',
+    FORCE_COLLECTSTATIC=False,
+    SETTINGS_MODULE=None,
+    STATIC_ROOT=None,
+    MIGRATE_PARALLELISM=1,
+    BOUNCE_BATCH_SIZE=1,
+    ROLLING_RESTART=False,
+    ROLLING_HOST_BATCH_SIZE=1,
+    READINESS_TIMEOUT=60,
+    INCREMENTAL_OWNERSHIPS=False,
+    SHOW_TIMINGS=True,
+    TRACE_FILE=None,
+    TRACE_CHROME_FILE=None,
+    WHEELHOUSE=False,
+    LOCAL_WHEELHOUSE='~/.cache/surge/wheelhouse',
+    WHEELHOUSE_PIP='pip',
+    RELEASES=False,
+    KEEP_RELEASES=5,
+    RELEASE_VENV_COMMAND='virtualenv venv && ln -sfn venv/bin/activate activate',
+    RELEASE_SHARED_PATHS=[],
+    FAST_FETCH=False,
+    GIT_REMOTE='origin',
+    FETCH_DEPTH=None,
+    FETCH_FILTER=None,
+    SUBMODULE_JOBS=1,
+    FORCE_DEPLOY=False,
+    STEP_CONCURRENCY=1,
+    SSH_MULTIPLEX=False,
+    SSH_CONTROL_PATH='~/.ssh/surge-%C',
+    SSH_CONTROL_PERSIST='10m',
+    SSH_KEEPALIVE=30,
+    ARTIFACT=False,
+    ARTIFACT_BUILD_HOST=None,
+    LOCAL_ARTIFACTS=None,
+    FANOUT=0,
+    FANOUT_SSH='ssh -o BatchMode=yes',
+    PRECOMPILE=False,
+    PRECOMPILE_JOBS=0,
+    WARMUP_REQUESTS=4,
+    DEPLOY_LOCK=False,
+    DEPLOY_QUEUE=False,
+    LOCK_TIMEOUT=1800,
+    LOCK_STALE=3600,
+    EXTRA_CONCURRENCY=4,
+    STATUS_CACHE='~/.cache/surge/status',
+    STATUS_TTL=15,
+    CANARY=0,
+    CANARY_REQUESTS=50,
+    CANARY_CONCURRENCY=5,
+    CANARY_MAX_P50=1.25,
+    CANARY_MAX_P99=1.5,
+    CANARY_MAX_ERRORS=0.01,
+    MIGRATION_INPUT_PATTERNS=[
+        '*/migrations/*.py',
+        '*models.py',
+        '*/models/*.py',
+        '*settings*.py',
+        'requirements*.txt',
+    ],
+    STATIC_INPUT_PATTERNS=[
+        '*/static/*',
+        'static/*',
+        '*.less',
+        '*.js',
+        '*.css',
+        '*settings*.py',
+        'requirements*.txt',
+    ],
 )
 
 REQUIRED_SETTINGS = [
@@ -77,8 +165,18 @@ class BASE_SETTINGS(object):
             new_settings.get('GROUP', self.kwargs['GROUP'])
         )
 
+        # With RELEASES the git checkout is only where releases are built from
         self.settings['GIT_TREE'] = new_settings.get('DEPLOY_PATH',
                                                      self.kwargs['DEPLOY_PATH'])
+        if new_settings.get('RELEASES', self.settings.get('RELEASES')):
+            self.settings['GIT_TREE'] += '/repo'
+
+        # A fleet target may only list HOSTS/HOST_GROUPS, HOST is then the first of them
+        if 'HOST' not in self.kwargs:
+            fleet = expand_hosts(new_settings.get('HOSTS', self.settings.get('HOSTS')),
+                                 new_settings.get('HOST_GROUPS', self.settings.get('HOST_GROUPS')))
+            if fleet:
+                self.settings['HOST'] = fleet[0]
 
         # Overide any of these automatically set settings from new_settings
         self.settings.update(new_settings)
@@ -117,6 +215,200 @@ def boold_up(kwargs):
         nd[nk] = nv
     return nd
 
+class TargetRegistry(object):
+    """
+    Deploy targets declared in one place (see load) rather than a fabfile
+    each, resolved into BASE_SETTINGS only once selected.
+
+    targets is {name: settings} where a target's settings can also have
+        extends: the name(s) of the targets it starts from
+        tags: names to select it by, with tag:name
+        abstract: True for a target only there to be extended
+    and defaults the settings every target starts from.
+    """
+    META = ('extends', 'tags', 'abstract')
+
+    def __init__(self, targets, defaults=None):
+        self.targets = dict(targets)
+        self.defaults = dict(defaults or {})
+        self.resolved = {}
+
+    @classmethod
+    def load(cls, source):
+        """
+        Loads the targets from a JSON (.json), YAML (.yml/.yaml, needs PyYAML) or
+        INI (.ini/.cfg) file of {defaults: {...}, targets: {name: {...}}}, a
+        [defaults] section and a section per target for INI, or a Python file or
+        module with DEFAULTS and TARGETS.
+        """
+        ext = os.path.splitext(source)[1].lower()
+        if ext == '.json':
+            with open(source) as f:
+                config = json.load(f)
+        elif ext in ('.yml', '.yaml'):
+            try:
+                import yaml
+            except ImportError:
+                abort(red("PyYAML is needed to load the targets from {0}".format(source)))
+            with open(source) as f:
+                config = yaml.safe_load(f)
+        elif ext in ('.ini', '.cfg'):
+            from ConfigParser import RawConfigParser
+            parser = RawConfigParser()
+            parser.optionxform = str
+            if not parser.read(source):
+                abort(red("Can't read the targets from {0}".format(source)))
+            sections = dict((s, dict((k, ini_value(v)) for k, v in parser.items(s))) for s in parser.sections())
+            config = {'defaults': sections.pop('defaults', {}), 'targets': sections}
+        else:
+            if ext == '.py':
+                import imp
+                module = imp.load_source('surge_targets', source)
+            else:
+                import importlib
+                module = importlib.import_module(source)
+            config = {'defaults': getattr(module, 'DEFAULTS', {}), 'targets': getattr(module, 'TARGETS', {})}
+        return cls(config.get('targets') or {}, config.get('defaults'))
+
+    def declared(self, name, seen=()):
+        """
+        The settings of a target as declared, with those of defaults and of the
+        targets it extends under them.
+        """
+        if name not in self.targets:
+            abort(red("Unknown target: {0}".format(name)))
+        if name in seen:
+            abort(red("Targets extending each other: {0}".format(' -> '.join(seen + (name,)))))
+
+        own = dict((k.lower() if k.lower() in self.META else k, v) for k, v in self.targets[name].items())
+        declared = dict(self.defaults)
+        for parent in listed(own.get('extends')):
+            declared.update(self.declared(parent, seen + (name,)))
+        declared.pop('abstract', None)
+        declared.update(own)
+        declared.pop('extends', None)
+        declared['tags'] = listed(declared.get('tags'))
+        return declared
+
+    def names(self):
+        """
+        The targets that can be deployed, those not abstract
+        """
+        return sorted(n for n in self.targets if not self.declared(n).get('abstract'))
+
+    def select(self, selection):
+        """
+        The names of the targets a selection of ';' separated target names,
+        fnmatch patterns and tag:name entries picks out, in order.
+        """
+        names, selected = self.names(), []
+        for entry in expand_hosts(selection):
+            if entry.startswith('tag:'):
+                matches = [n for n in names if entry[len('tag:'):] in self.declared(n)['tags']]
+            else:
+                matches = fnmatch.filter(names, entry)
+            if not matches:
+                abort(red("No target matches {0}".format(entry)))
+            selected += [n for n in matches if n not in selected]
+        return selected
+
+    def settings(self, name):
+        """
+        The BASE_SETTINGS of a target, built (and validated) the first time
+        """
+        if name not in self.resolved:
+            declared = self.declared(name)
+            for meta in self.META:
+                declared.pop(meta, None)
+            # Possibly resolved lazily from within a surge_stack task, which BASE_SETTINGS would reset
+            stack = env.get('surge_stack')
+            try:
+                self.resolved[name] = BASE_SETTINGS(**declared)
+            except (ValueError, KeyError) as e:
+                abort(red("Invalid settings for target {0}: {1}".format(name, str(e) or 'see above')))
+            env['surge_stack'] = stack
+        return self.resolved[name]
+
+class LazyTarget(object):
+    """
+    Stands in for env.deploy_settings until a task first uses it, then becomes
+    the target's settings (and sets env.host_string, see select_target).
+    """
+    def __init__(self, registry, name):
+        self.__dict__['target'] = (registry, name)
+
+    def __getattr__(self, attr):
+        registry, name = self.__dict__['target']
+        return getattr(select_target(registry, name), attr)
+
+    def __setattr__(self, attr, value):
+        registry, name = self.__dict__['target']
+        setattr(select_target(registry, name), attr, value)
+
+def ini_value(value):
+    """
+    A Python literal of a targets INI file as the value, anything else as a string
+    """
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+def listed(value):
+    """
+    A list, comma and/or whitespace separated for a string
+    """
+    if not value:
+        return []
+    if isinstance(value, basestring):
+        return [v for v in re.split(r'[,\s]+', value) if v]
+    return list(value)
+
+def use_targets(source, default=None):
+    """
+    Takes the deploy targets from a TargetRegistry, or the file or module to
+    load one from, for fab deploy:target=... and the target task.
+
+    The default target, if any, is only resolved once a task uses its settings.
+    """
+    env.deploy_targets = source if isinstance(source, TargetRegistry) else TargetRegistry.load(source)
+    if default:
+        env.deploy_settings = LazyTarget(env.deploy_targets, default)
+    return env.deploy_targets
+
+def select_target(registry, name):
+    """
+    Makes a target the current one, returns its settings
+    """
+    ds = registry.settings(name)
+    env.deploy_settings = ds
+    env.surge_target = name
+    if not env.hosts:
+        env.host_string = ds.HOST
+    return ds
+
+@contextmanager
+def target_selected(name):
+    """
+    Makes a target the current one (see select_target) until the end of the block
+    """
+    with settings(deploy_settings=env.get('deploy_settings'), host_string=env.host_string,
+                  surge_target=env.get('surge_target')):
+        select_target(env.deploy_targets, name)
+        yield
+
+def selected_targets(kwargs):
+    """
+    The names of the targets a task is to run against: those of :target= (popped
+    from kwargs), or else those picked with the target task, if any.
+    """
+    selection = kwargs.pop('target', None)
+    if selection is None:
+        return env.get('surge_targets') or []
+    if not env.get('deploy_targets'):
+        abort(red("target= needs the deploy targets, see use_targets"))
+    return env.deploy_targets.select(selection)
+
 def bool_opt(opt, kwargs, default=False):
     """
     Will convert opt strings to python True/False, if it exists in kwargs.
@@ -153,15 +445,47 @@ def surge_stack(f):
     might if called alone.
 
     A surge_stack task can always override settings with it's kwargs
+
+    A surge_stack task is timed along with every surge task and remote command
+    it runs, see timed.
+
+    A surge_stack task runs against the target(s) selected, see targeted.
     """
     @wraps(f)
     def stash_surge_task(*args, **kwargs):
         env['surge_stack'] = f.__name__
         env.deploy_settings.update(kwargs)
-        show_settings()
-        return f(*args, **kwargs)
+        with trace_session():
+            with tracing('task', f.__name__, host='local'):
+                show_settings()
+                return f(*args, **kwargs)
 
-    return stash_surge_task
+    return targeted(stash_surge_task)
+
+def targeted(f):
+    """
+    A decorator on a task to run it against the deploy target(s) selected with
+    :target= or the target task (see use_targets), against each of several in
+    turn, then returning {target: result}.
+    """
+    @wraps(f)
+    def select(*args, **kwargs):
+        if env.get('surge_on_host'):
+            kwargs.pop('target', None)
+            return f(*args, **kwargs)
+        targets = selected_targets(kwargs)
+        if len(targets) > 1:
+            results = {}
+            for name in targets:
+                print blue("Target {0}".format(name))
+                with settings(surge_targets=[name]):
+                    results[name] = select(*args, **kwargs)
+            return results
+        if targets and targets[0] != env.get('surge_target'):
+            with target_selected(targets[0]):
+                return f(*args, **kwargs)
+        return f(*args, **kwargs)
+    return select
 
 def skip_if_not(setting, what=True):
     """
@@ -178,6 +502,20 @@ def skip_if_not(setting, what=True):
         return wrapper
     return requires
 
+def skip_if_deployed(f):
+    """
+    A decorator on a task to skip it during a deploy when the host already
+    had the same commit, requirements and EXTRA_COMMANDS deployed (see
+    check_deployed). Called on its own the task always runs.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if env.get('surge_unchanged'):
+            say(green("Skipping {0}, nothing changed since the last deploy".format(f.__name__)))
+            return
+        return f(*args, **kwargs)
+    return wrapper
+
 def can_override_settings(f):
     """
     A task that when called command line can have its kwargs override the settings of the deploy
@@ -189,10 +527,1142 @@ def can_override_settings(f):
         return f(*args, **kwargs)
     return override
 
+@contextmanager
+def trace_session():
+    """
+    Collects the timings of everything run within into env.surge_trace and
+    reports them at the end (see report_trace). Nested sessions just add to the
+    outer one.
+    """
+    if env.get('surge_trace') is not None:
+        yield
+        return
+
+    with settings(surge_trace=[]):
+        try:
+            yield
+        finally:
+            report_trace(env.surge_trace)
+
+def trace_event(kind, name, started, duration, status='ok', host=None, **extra):
+    trace = env.get('surge_trace')
+    if trace is not None:
+        event = {
+            'kind': kind,
+            'name': name,
+            'host': host or env.host_string or 'local',
+            'start': started,
+            'duration': duration,
+            'status': status,
+        }
+        event.update(extra)
+        trace.append(event)
+
+@contextmanager
+def tracing(kind, name, host=None):
+    """
+    Records how long the wrapped block took as a kind (task, host, command) event
+    """
+    started = time.time()
+    status = 'failed'
+    try:
+        yield
+        status = 'ok'
+    finally:
+        trace_event(kind, name, started, time.time() - started, status, host)
+
+def timed(f):
+    """
+    A decorator on a task to time it, per host, into the current trace.
+    A :target= (see use_targets) selects the one target it runs against.
+
+    Every surge task is timed. Decorate a project's own tasks with it (or
+    surge_stack) to have them show up in the timings and trace files too.
+    """
+    @wraps(f)
+    def timer(*args, **kwargs):
+        if 'target' in kwargs and not env.get('surge_on_host'):
+            targets = selected_targets(kwargs)
+            if len(targets) > 1:
+                abort(red("{0} runs against one target at a time, not {1}".format(f.__name__, ', '.join(targets))))
+            with target_selected(targets[0]):
+                return timer(*args, **kwargs)
+        with trace_session():
+            with tracing('task', f.__name__):
+                return f(*args, **kwargs)
+    return timer
+
+def report_trace(events):
+    """
+    Prints the timings summary (SHOW_TIMINGS) and writes the events to
+    TRACE_FILE as JSON lines and to TRACE_CHROME_FILE in the Chrome trace event
+    format (load it in chrome://tracing or Perfetto).
+    """
+    if not events or not env.get('deploy_settings'):
+        return
+    ds = env.deploy_settings
+
+    if bool_opt('show_timings', {}, default=True) and any(e['kind'] == 'command' for e in events):
+        print_timings(events)
+
+    session = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(min(e['start'] for e in events)))
+    if getattr(ds, 'TRACE_FILE', None):
+        with open(ds.TRACE_FILE, 'a') as f:
+            for event in events:
+                f.write(json.dumps(dict(event, session=session)) + '\n')
+        print cyan("Trace appended to {0}".format(ds.TRACE_FILE))
+
+    if getattr(ds, 'TRACE_CHROME_FILE', None):
+        hosts = []
+        for event in events:
+            if event['host'] not in hosts:
+                hosts.append(event['host'])
+        trace = [{'name': 'process_name', 'ph': 'M', 'pid': hosts.index(h), 'args': {'name': h}}
+                 for h in hosts]
+        for event in sorted(events, key=lambda e: e['start']):
+            trace.append({
+                'name': event['name'],
+                'cat': event['kind'],
+                'ph': 'X',
+                'ts': int(event['start'] * 1000000),
+                'dur': int(event['duration'] * 1000000),
+                'pid': hosts.index(event['host']),
+                'tid': 1 if event['kind'] == 'command' else 0,
+                'args': {'status': event['status']},
+            })
+        with open(ds.TRACE_CHROME_FILE, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+        print cyan("Chrome trace written to {0}".format(ds.TRACE_CHROME_FILE))
+
+def print_timings(events):
+    tasks = {}
+    order = []
+    for event in events:
+        if event['kind'] != 'task':
+            continue
+        if event['name'] not in tasks:
+            order.append(event['name'])
+            tasks[event['name']] = []
+        tasks[event['name']].append(event)
+
+    print ""
+    print blue("Timings:")
+    print "{0:<28} {1:>5} {2:>9} {3:>9}  {4}".format('task', 'runs', 'total', 'max', 'slowest host')
+    for name in order:
+        runs = tasks[name]
+        slowest = max(runs, key=lambda e: e['duration'])
+        print "{0:<28} {1:>5} {2:>8.1f}s {3:>8.1f}s  {4}".format(
+            name, len(runs), sum(e['duration'] for e in runs), slowest['duration'], slowest['host'])
+
+    commands = sorted([e for e in events if e['kind'] == 'command'], key=lambda e: -e['duration'])
+    print ""
+    print blue("Slowest remote commands ({0} run):".format(len(commands)))
+    for event in commands[:10]:
+        print "{0:>8.1f}s  {1:<30} {2}".format(event['duration'], event['host'],
+                                               event['name'].strip().splitlines()[0][:80])
+
+    round_trips = [e for e in events if e['kind'] == 'batch' or (e['kind'] == 'command' and 'batch' not in e)]
+    opened = [e for e in events if e['kind'] == 'connection']
+    print ""
+    print blue("SSH: {0} round-trips, {1} connections opened ({2:.1f}s), {3} reused".format(
+        len(round_trips), len(opened), sum(e['duration'] for e in opened), len(round_trips) - len(opened)))
+
+    hosts = [e for e in events if e['kind'] == 'host']
+    if hosts:
+        print ""
+        print blue("Host timings:")
+        for event in sorted(hosts, key=lambda e: -e['duration']):
+            print "{0:>8.1f}s  {1:<30} {2}".format(event['duration'], event['host'], event['status'])
+    print ""
+
+def expand_hosts(entries, groups=None):
+    """
+    Will expand a list of hosts and/or HOST_GROUPS names into a list of unique
+    host strings, keeping their order.
+    A string is taken as a ';' separated list (as supplied command line).
+    With no entries every host of every group is returned.
+    """
+    groups = groups or {}
+    if isinstance(entries, basestring):
+        entries = [e.strip() for e in entries.split(';') if e.strip()]
+    if not entries:
+        entries = sorted(groups.keys())
+
+    hosts = []
+    for entry in entries:
+        for host in groups.get(entry, [entry]):
+            if host not in hosts:
+                hosts.append(host)
+    return hosts
+
+def target_hosts():
+    """
+    The hosts of the deploy target.
+
+    HOST_GROUP (a group name or ';' separated names) narrows the target down to
+    those groups of HOST_GROUPS, otherwise HOSTS is used, otherwise HOST.
+    env.surge_hosts (see fan_out) narrows it down further.
+    """
+    if env.get('surge_hosts'):
+        return list(env.surge_hosts)
+
+    ds = env.deploy_settings
+    groups = getattr(ds, 'HOST_GROUPS', None) or {}
+    selected = getattr(ds, 'HOST_GROUP', None)
+    if selected:
+        selected = expand_hosts(selected)
+        unknown = [g for g in selected if g not in groups]
+        if unknown:
+            abort(red("Unknown HOST_GROUP: {0}".format(', '.join(unknown))))
+        return expand_hosts(selected, groups)
+
+    if getattr(ds, 'HOSTS', None) or groups:
+        return expand_hosts(getattr(ds, 'HOSTS', None), groups)
+
+    return [ds.HOST]
+
+def on_hosts(f, *args, **kwargs):
+    """
+    Runs f against every host of the deploy target, PARALLEL_POOL_SIZE hosts at
+    a time, and prints a per host summary. Returns {host: result dict}.
+
+    An abort on one host only fails that host. With FAIL_FAST=True hosts that
+    have not started yet are skipped once a host has failed, otherwise every
+    host is attempted. Either way the run aborts after the summary if any host
+    failed.
+
+    With env.surge_wave_size set the hosts are worked through in waves of that
+    many, each wave finishing before the next starts and no further waves
+    once a host has failed.
+
+    Nothing is printed of the run itself with Fabric's status output hidden.
+    """
+    hosts = target_hosts()
+    pool_size = int(getattr(env.deploy_settings, 'PARALLEL_POOL_SIZE', 1) or 1)
+    fail_fast = bool_opt('fail_fast', kwargs, default=False)
+    failed = multiprocessing.Event()
+
+    def host_run(*args, **kwargs):
+        if fail_fast and failed.is_set():
+            return {'status': 'skipped', 'elapsed': 0.0}
+
+        started = time.time()
+        # A trace of its own to hand back, this may well be another process
+        with settings(surge_on_host=True, surge_trace=[], surge_release=None, surge_unchanged=None,
+                      surge_manifest=None):
+            try:
+                with tracing('host', f.__name__):
+                    result = f(*args, **kwargs)
+            except (SystemExit, Exception) as e:
+                failed.set()
+                return {'status': 'failed',
+                        'error': getattr(e, 'message', '') or repr(e),
+                        'elapsed': time.time() - started,
+                        'trace': env.surge_trace}
+            return {'status': 'ok', 'result': result, 'elapsed': time.time() - started,
+                    'trace': env.surge_trace}
+    host_run.__name__ = f.__name__
+
+    wave_size = int(env.get('surge_wave_size') or len(hosts))
+    if output.status:
+        print cyan("Running {0} on {1} host(s), {2} at a time{3}".format(
+            f.__name__, len(hosts), min(pool_size, wave_size), " (FAIL_FAST)" if fail_fast else ""))
+    results = {}
+    for i in range(0, len(hosts), wave_size):
+        wave = hosts[i:i + wave_size]
+        if failed.is_set():
+            results.update((h, {'status': 'skipped', 'elapsed': 0.0}) for h in wave)
+            continue
+        if wave_size < len(hosts) and output.status:
+            print cyan("Wave {0}: {1}".format(i / wave_size + 1, ', '.join(wave)))
+        with settings(parallel=pool_size > 1, pool_size=pool_size):
+            results.update(execute(host_run, *args, hosts=wave, **kwargs))
+
+    # Anything not a result dict is an error Fabric caught for us (ie. NetworkError)
+    for host, result in results.items():
+        if not isinstance(result, dict):
+            results[host] = {'status': 'failed', 'error': str(result), 'elapsed': 0.0}
+        if env.get('surge_trace') is not None:
+            env.surge_trace.extend(results[host].pop('trace', []))
+
+    if output.status:
+        print_host_summary(hosts, results)
+
+    failures = [h for h in hosts if results[h]['status'] != 'ok']
+    if failures:
+        abort(red("{0} failed on {1} of {2} host(s): {3}".format(
+            f.__name__, len(failures), len(hosts), ', '.join(failures))))
+    return results
+
+def print_host_summary(hosts, results):
+    colors = {'ok': green, 'failed': red, 'skipped': yellow}
+    print ""
+    print blue("Host summary:")
+    for host in hosts:
+        result = results[host]
+        print colors[result['status']]("{0:<40} {1:<8} {2:>7.1f}s  {3}".format(
+            host, result['status'], result['elapsed'], result.get('error', '')))
+    print ""
+
+def fleet(f):
+    """
+    A decorator on a task to run it against every host of the deploy target
+    (see on_hosts) when the target has more than the one current host.
+
+    Tasks called while already running on a host, or when Fabric was given the
+    hosts itself (fab -H), run as they are.
+
+    The task runs against the target(s) selected, see targeted.
+    """
+    @wraps(f)
+    def dispatch(*args, **kwargs):
+        if env.get('surge_on_host') or env.hosts:
+            return f(*args, **kwargs)
+        if target_hosts() == [env.host_string]:
+            return f(*args, **kwargs)
+        with trace_session():
+            return on_hosts(f, *args, **kwargs)
+    return targeted(dispatch)
+
+class RemoteBatch(object):
+    """
+    Collects the remote commands of a deploy phase so they can be run as one
+    remote shell script over a single channel (see batched).
+
+    Each command keeps the cd()/prefix() context and the sudo-ness it was
+    queued with. The script marks where each command starts and ends so its
+    output and exit code can be split back out, replayed like run()/sudo()
+    would have printed it, and aborted on the same way.
+    """
+    BEGIN = '@@surge-step'
+    END = '@@surge-done'
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = []
+
+    def add(self, command, use_sudo=False, warn_only=False):
+        self.steps.append({
+            'command': command,
+            'sudo': use_sudo,
+            'warn_only': warn_only,
+            'cwd': env.cwd,
+            'prefixes': list(env.command_prefixes),
+        })
+
+    def note(self, text):
+        self.steps.append({'note': text})
+
+    def script(self, steps):
+        """
+        Groups consecutive commands sharing a context so the cd and prefixes
+        (ie. source activate) only happen once per group.
+        """
+        use_sudo = any(s.get('sudo') for s in steps)
+        groups = []
+        for i, step in enumerate(steps):
+            if 'command' not in step:
+                continue
+            context = (step['cwd'], tuple(step['prefixes']), step['sudo'])
+            if not groups or groups[-1][0] != context:
+                groups.append((context, []))
+            groups[-1][1].append((i, step))
+
+        script = []
+        for (cwd, prefixes, step_sudo), members in groups:
+            lines = []
+            setup = (['cd {0} >/dev/null'.format(cwd)] if cwd else []) + list(prefixes)
+            if setup:
+                lines.append('{0} || exit $?'.format(' && '.join(setup)))
+            for i, step in members:
+                lines.append('echo "{0} {1} $(date +%s.%N)"'.format(self.BEGIN, i))
+                lines.append('(\n{0}\n) 2>&1'.format(step['command']))
+                lines.append("rc=$?; printf '\\n{0} {1} %s %s\\n' $rc \"$(date +%s.%N)\"".format(
+                    self.END, i))
+                if not step['warn_only']:
+                    lines.append('[ $rc -eq 0 ] || exit $rc')
+            group = '\n'.join(lines)
+
+            if use_sudo and not step_sudo:
+                # The script runs as root, run these as the user we logged in as
+                script.append('sudo -u "$SUDO_USER" -H {0} {1} || exit $?'.format(
+                    env.shell, pipes.quote(group)))
+            else:
+                script.append('(\n{0}\n) || exit $?'.format(group))
+        return use_sudo, '\n'.join(script)
+
+    def parse(self, out):
+        """
+        Splits the script output into {step index: (output, exit code)}.
+        A step that never reached its end marker gets an exit code of None.
+        The remote step start/end times go to self.times {step index: (start, end)}.
+        """
+        def stamp(fields):
+            try:
+                return float(fields[0])
+            except (IndexError, ValueError):
+                return None
+
+        results = {}
+        self.times = {}
+        current, lines = None, []
+        for line in out.splitlines():
+            if line.startswith(self.BEGIN + ' '):
+                fields = line.split()
+                current, lines = int(fields[1]), []
+                self.times[current] = (stamp(fields[2:]), None)
+            elif line.startswith(self.END + ' ') and current is not None:
+                fields = line.split()
+                results[current] = ('\n'.join(lines).rstrip('\n'), int(fields[2]))
+                self.times[current] = (self.times[current][0], stamp(fields[3:]))
+                current = None
+            elif current is not None:
+                lines.append(line)
+        if current is not None:
+            results[current] = ('\n'.join(lines).rstrip('\n'), None)
+        return results
+
+    def trace(self, steps, results, started):
+        """
+        Adds each step's timing to the trace, placed by the remote clock relative
+        to the first step (it need not agree with ours).
+        """
+        remote_start = min([t[0] for t in self.times.values() if t[0] is not None] or [None])
+        for i, (step_start, step_end) in sorted(self.times.items()):
+            if step_start is None or step_end is None:
+                continue
+            trace_event('command', steps[i]['command'], started + step_start - remote_start,
+                        step_end - step_start, 'ok' if results[i][1] == 0 else 'failed', batch=self.name)
+
+    def flush(self):
+        """
+        Runs everything queued so far and replays it.
+        """
+        steps, self.steps = self.steps, []
+        if not any('command' in s for s in steps):
+            for step in steps:
+                print step['note']
+            return
+
+        use_sudo, script = self.script(steps)
+        started = time.time()
+        with settings(hide('running', 'stdout', 'stderr'), cwd='', command_prefixes=[], warn_only=True):
+            out = remote_run(script, use_sudo)
+        trace_event('batch', self.name, started, time.time() - started,
+                    'failed' if out.failed else 'ok')
+        results = self.parse(out)
+        self.trace(steps, results, started)
+
+        for i, step in enumerate(steps):
+            if 'note' in step:
+                print step['note']
+                continue
+            if i not in results:
+                break
+
+            step_out, rc = results[i]
+            if output.running:
+                print "[{0}] {1}: {2}".format(env.host_string,
+                                              'sudo' if step['sudo'] else 'run',
+                                              step['command'])
+            if output.stdout:
+                for line in step_out.splitlines():
+                    print "[{0}] out: {1}".format(env.host_string, line)
+            if rc != 0 and not step['warn_only']:
+                abort(red("{0}() received nonzero return code {1} while executing!\n\n"
+                          "Requested: {2}".format('sudo' if step['sudo'] else 'run',
+                                                  rc, step['command'])))
+
+        if out.failed and not any(rc not in (0, None) for _, rc in results.values()):
+            abort(red("Batched '{0}' commands failed:\n{1}".format(self.name, out)))
+
+@contextmanager
+def batched(name):
+    """
+    With BATCH_REMOTE_COMMANDS=True the remote() commands of the wrapped phase
+    are run as one remote script at the end of it, or as soon as a command
+    needs its result. Otherwise (or already inside a batch) does nothing.
+    """
+    if env.get('surge_batch') is not None or not bool_opt('batch_remote_commands', {}):
+        yield
+        return
+
+    batch = RemoteBatch(name)
+    with settings(surge_batch=batch):
+        yield
+        batch.flush()
+
+def remote(command, use_sudo=False, capture=False, **kwargs):
+    """
+    run() or sudo() a command, or queue it onto the open batch.
+
+    Commands whose result is needed (capture=True) or that use other run()
+    options (quiet, user...) flush the batch and run right away.
+    """
+    batch = env.get('surge_batch')
+    if batch is not None:
+        if not capture and set(kwargs) <= set(['warn_only']):
+            batch.add(command, use_sudo, kwargs.get('warn_only', False))
+            return None
+        batch.flush()
+    with tracing('command', command):
+        return remote_run(command, use_sudo, **kwargs)
+
+def remote_run(command, use_sudo=False, **kwargs):
+    """
+    run() or sudo() a command right away, connecting to the host first if there
+    is no connection to reuse (noted in the trace as a 'connection' event).
+    With SSH_MULTIPLEX=True the command goes over the host's ssh master instead
+    of fabric's own connection (see ssh_run).
+    """
+    if not ssh_connected():
+        with tracing('connection', 'opened'):
+            ssh_connect()
+    if bool_opt('ssh_multiplex', {}):
+        return ssh_run(command, use_sudo, **kwargs)
+    return sudo(command, **kwargs) if use_sudo else run(command, **kwargs)
+
+def ssh_options(master=False):
+    """
+    The OpenSSH options to share one ControlMaster connection per host between
+    commands, processes and fab invocations (SSH_MULTIPLEX). Only the master
+    is started with ControlMaster=auto, a command never becomes one itself.
+    """
+    ds = env.deploy_settings
+    options = [
+        '-o', 'ControlPath={0}'.format(os.path.expanduser(getattr(ds, 'SSH_CONTROL_PATH', '~/.ssh/surge-%C'))),
+        '-o', 'ControlMaster={0}'.format('auto' if master else 'no'),
+        '-o', 'ServerAliveInterval={0}'.format(ssh_keepalive()),
+        '-o', 'BatchMode=yes',
+    ]
+    if master:
+        options += ['-o', 'ControlPersist={0}'.format(getattr(ds, 'SSH_CONTROL_PERSIST', '10m'))]
+    return options
+
+def ssh_args(*args):
+    """
+    The ssh command line for the current host, ending with args
+    """
+    user, host, port = normalize(env.host_string)
+    keys = env.key_filename or []
+    if isinstance(keys, basestring):
+        keys = [keys]
+    command = ['ssh', '-p', str(port)] + (['-A'] if env.forward_agent else [])
+    for key in keys:
+        command += ['-i', os.path.expanduser(key)]
+    return command + list(args) + ['{0}@{1}'.format(user, host)]
+
+def ssh_keepalive():
+    return int(env.keepalive or getattr(env.deploy_settings, 'SSH_KEEPALIVE', 0) or 0)
+
+def ssh_connected():
+    """
+    Whether there is a connection to the host to reuse: fabric's own (kept per
+    process), or with SSH_MULTIPLEX=True a master left by this or an earlier
+    fab invocation that has not outlived SSH_CONTROL_PERSIST.
+    """
+    if not bool_opt('ssh_multiplex', {}):
+        return env.host_string in connections
+    masters = env.setdefault('surge_ssh_masters', set())
+    if env.host_string not in masters:
+        with open(os.devnull, 'w') as devnull:
+            if subprocess.call(ssh_args(*ssh_options() + ['-O', 'check']),
+                               stdout=devnull, stderr=devnull) != 0:
+                return False
+        masters.add(env.host_string)
+    return True
+
+def ssh_connect():
+    """
+    Opens the connection to the host, with SSH_KEEPALIVE.
+    With SSH_MULTIPLEX=True that is a background master kept for SSH_CONTROL_PERSIST.
+    """
+    if not bool_opt('ssh_multiplex', {}):
+        with settings(keepalive=ssh_keepalive()):
+            connections.connect(env.host_string)
+        return
+
+    control_dir = os.path.dirname(os.path.expanduser(env.deploy_settings.SSH_CONTROL_PATH))
+    if control_dir and not os.path.isdir(control_dir):
+        os.makedirs(control_dir, 0o700)
+    # The master stays in the background, it must not hold on to our output
+    with open(os.devnull, 'w') as devnull:
+        if subprocess.call(ssh_args(*ssh_options(master=True) + ['-f', '-N']),
+                           stdin=devnull, stdout=devnull, stderr=devnull) != 0:
+            abort(red("Could not open an ssh connection to {0}, SSH_MULTIPLEX=True needs "
+                      "key authentication (try: ssh {0})".format(env.host_string)))
+    env.setdefault('surge_ssh_masters', set()).add(env.host_string)
+
+## What sudo prompts for the password with in ssh_run, answered with env.sudo_password
+SUDO_PROMPT = '@@surge-sudo-password:'
+
+def ssh_run(command, use_sudo=False, quiet=False, warn_only=False, **kwargs):
+    """
+    What run()/sudo() do, over the host's ssh master (SSH_MULTIPLEX).
+    There is no pty, sudo has to work without one and either without a
+    password or with env.sudo_password, which is only sent when sudo prompts
+    for it (SUDO_PROMPT). The command itself gets no stdin.
+    """
+    sudo_prefix = None
+    command_line = _prefix_commands(command, 'remote')
+    if use_sudo:
+        sudo_prefix = "sudo -S -p '{0}'".format(SUDO_PROMPT)
+        if kwargs.get('user'):
+            sudo_prefix += ' -u "{0}"'.format(kwargs['user'])
+        # stdin stays open for sudo's prompt, the command is not to read it
+        command_line = 'exec < /dev/null; ' + command_line
+    real_command = _shell_wrap(_prefix_env_vars(command_line),
+                               env.get('shell_escape', True), kwargs.get('shell', True), sudo_prefix)
+    which = 'sudo' if use_sudo else 'run'
+    if output.running and not quiet:
+        print "[{0}] {1}: {2}".format(env.host_string, which, command)
+
+    process = subprocess.Popen(ssh_args(*ssh_options()) + [real_command], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    password = env.sudo_password or env.password
+    if not (use_sudo and password):
+        process.stdin.close()
+    lines, pending = [], ''
+
+    def emit(line):
+        lines.append(line.rstrip('\r'))
+        if output.stdout and not quiet:
+            print "[{0}] out: {1}".format(env.host_string, lines[-1])
+
+    for chunk in iter(lambda: os.read(process.stdout.fileno(), 4096), ''):
+        pending += chunk
+        if SUDO_PROMPT in pending:
+            # The prompt has no newline of its own, answered (again) whenever it shows
+            pending = pending.replace(SUDO_PROMPT, '')
+            if not process.stdin.closed:
+                process.stdin.write(password + '\n')
+                process.stdin.flush()
+        done = pending.split('\n')
+        pending = done.pop()
+        for line in done:
+            emit(line)
+    if pending:
+        emit(pending)
+    if not process.stdin.closed:
+        process.stdin.close()
+    process.wait()
+
+    result = _AttributeString('\n'.join(lines))
+    result.command = command
+    result.real_command = real_command
+    result.return_code = process.returncode
+    result.failed = process.returncode != 0
+    result.succeeded = not result.failed
+    result.stderr = ''
+    if result.failed:
+        message = "{0}() received nonzero return code {1} while executing!\n\nRequested: {2}\nExecuted: {3}".format(
+            which, process.returncode, command, real_command)
+        if not (quiet or warn_only or env.warn_only):
+            abort(red(message))
+        if not quiet and output.warnings:
+            print yellow("\nWarning: {0}\n".format(message))
+    return result
+
+@task
+def ssh_pool(close=False):
+    """
+    Shows the hosts' ssh masters (SSH_MULTIPLEX), :close=True closes them
+    """
+    close = strtobool(close) if isinstance(close, basestring) else close
+    for host in target_hosts():
+        with settings(host_string=host):
+            with open(os.devnull, 'w') as devnull:
+                check = subprocess.Popen(ssh_args(*ssh_options() + ['-O', 'exit' if close else 'check']),
+                                         stdout=devnull, stderr=subprocess.PIPE)
+                status = check.communicate()[1].strip()
+            if check.returncode != 0:
+                print "{0}: {1}".format(host, yellow('no master'))
+            elif close:
+                print "{0}: {1}".format(host, cyan('closed'))
+            else:
+                print "{0}: {1} ({2})".format(host, green('connected'), status)
+
+def say(text):
+    """
+    print text, in order with the commands of the open batch.
+    """
+    batch = env.get('surge_batch')
+    if batch is not None:
+        batch.note(text)
+    else:
+        print text
+
+def project_path():
+    """
+    Where the project is on the host: DEPLOY_PATH, or with RELEASES=True the
+    release being built (see build_release) and otherwise DEPLOY_PATH/current.
+    """
+    if not bool_opt('releases', {}):
+        return env.deploy_settings.DEPLOY_PATH
+    return env.get('surge_release') or '{0}/current'.format(env.deploy_settings.DEPLOY_PATH)
+
+def release_path(head):
+    return '{0}/releases/{1}'.format(env.deploy_settings.DEPLOY_PATH, head)
+
+def repo_head():
+    """
+    The commit checked out in GIT_TREE, or with ARTIFACT=True the commit of
+    the artifact being deployed
+    """
+    artifact = env.get('surge_artifact')
+    if artifact and bool_opt('artifact', {}):
+        return artifact['commit']
+    with cd(env.deploy_settings.GIT_TREE):
+        out = remote('echo "@@head $(git rev-parse HEAD)"', capture=True, quiet=True)
+    for line in out.splitlines():
+        if line.startswith('@@head ') and len(line.split()) > 1:
+            return line.split()[1]
+    abort(red("Could not find the commit checked out in {0}".format(env.deploy_settings.GIT_TREE)))
+
+def state_file(name):
+    """
+    Path of a file surge keeps its own state in on the host.
+    SURGE_STATE_DIR is relative to the project (see project_path), the default
+    lives inside .git so it never shows up in git status.
+    """
+    return '{0}/{1}/{2}'.format(project_path(), env.deploy_settings.SURGE_STATE_DIR, name)
+
+def requirements_files():
+    files = getattr(env.deploy_settings, 'REQUIREMENTS_FILES', None) or ['requirements.txt']
+    if isinstance(files, basestring):
+        files = files.split(';')
+    return files
+
+def local_requirements_hash():
+    """
+    sha1 of the local requirements files, the same as the host computes it
+    """
+    sha = hashlib.sha1()
+    for name in requirements_files():
+        with open(name, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+def requirements_hashes():
+    """
+    Returns (sha1 of the requirements files, sha1 recorded by the last
+    successful install) from the host in one round-trip.
+    """
+    with cd(project_path()):
+        out = remote('echo "@@requirements $(cat {0} | sha1sum | cut -c1-40) $(cat {1} 2>/dev/null)"'.format(
+            ' '.join(requirements_files()), state_file('requirements.sha1')), capture=True, quiet=True)
+    for line in out.splitlines():
+        if line.startswith('@@requirements '):
+            hashes = line.split()[1:] + ['']
+            return hashes[0], hashes[1]
+    return '', ''
+
+
+def recorded_requirements_hash(*args, **kwargs):
+    return requirements_hashes()[1]
+
+def local_cache(name, default):
+    """
+    The local directory setting name points to, ~ expanded. Defaults live in
+    ~/.cache/surge so they do not dirty the work tree (see REQUIRE_CLEAN).
+    """
+    return os.path.expanduser(getattr(env.deploy_settings, name, None) or default)
+
+def wheelhouse_dir():
+    """
+    The local wheelhouse for the current requirements, LOCAL_WHEELHOUSE/<sha1>
+    """
+    return os.path.join(local_cache('LOCAL_WHEELHOUSE', '~/.cache/surge/wheelhouse'),
+                        local_requirements_hash())
+
+def push_wheelhouse(path):
+    """
+    rsyncs the local wheelhouse to the host so only new wheels are transferred.
+    Returns where it is on the host.
+    """
+    target = state_file('wheelhouse')
+    if relay_rsync(target + '/', target + '/', ['--exclude=.complete']):
+        return target
+    say(cyan("Pushing wheelhouse {0}".format(path)))
+    rsync_project(remote_dir=target + '/', local_dir=path + '/', delete=True, exclude='.complete',
+                  default_opts='-rtz', extra_opts='--rsync-path="mkdir -p {0} && rsync"'.format(target),
+                  ssh_opts=' '.join(ssh_options()) if bool_opt('ssh_multiplex', {}) else '')
+    return target
+
+## sha1 of the sha1sum listing of the files of a release but .git, see tree_checksum
+ARTIFACT_CHECKSUM = 'find . -path ./.git -prune -o -type f -print0 | LC_ALL=C sort -z | xargs -0 -r sha1sum | sha1sum | cut -c1-40'
+
+def tree_checksum(path):
+    """
+    What ARTIFACT_CHECKSUM comes to for the local directory
+    """
+    files = []
+    for root, dirs, names in os.walk(path):
+        if root == path and '.git' in dirs:
+            dirs.remove('.git')
+        for name in names:
+            full = os.path.join(root, name)
+            if os.path.isfile(full) and not os.path.islink(full):
+                files.append('./' + os.path.relpath(full, path))
+
+    listing = hashlib.sha1()
+    for name in sorted(files):
+        sha = hashlib.sha1()
+        with open(os.path.join(path, name), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), ''):
+                sha.update(chunk)
+        listing.update('{0}  {1}\n'.format(sha.hexdigest(), name))
+    return listing.hexdigest()
+
+def artifacts_dir():
+    """
+    LOCAL_ARTIFACTS, by default a directory of ~/.cache/surge/artifacts of its
+    own for the local checkout, as build_artifact prunes the artifacts in it
+    """
+    here = os.path.abspath(os.getcwd())
+    return local_cache('LOCAL_ARTIFACTS', '~/.cache/surge/artifacts/{0}-{1}'.format(
+        os.path.basename(here), hashlib.sha1(here).hexdigest()[:8]))
+
+def artifact_filters():
+    """
+    The rsync filters leaving the git repository out of an artifact, all but
+    SURGE_STATE_DIR (without its wheelhouse) when that is inside it.
+    """
+    state = env.deploy_settings.SURGE_STATE_DIR.strip('/')
+    parts = state.split('/')
+    if parts[0] != '.git':
+        return ['--exclude=/.git']
+    filters = ['--exclude=/{0}/wheelhouse'.format(state)]
+    filters += ['--include=/{0}/'.format('/'.join(parts[:i])) for i in range(1, len(parts))]
+    return filters + ['--include=/{0}/***'.format(state), '--exclude=/.git/**']
+
+def fan_out_tiers(hosts, width):
+    """
+    Splits the hosts into tiers of width, width*width... hosts, each host
+    paired with the host of the tier before it relays to it (None for the first).
+    """
+    tiers, start, size = [], 0, width
+    while start < len(hosts):
+        tiers.append([(host, hosts[(i - width) // width] if i >= width else None)
+                      for i, host in enumerate(hosts[start:start + size], start)])
+        start += size
+        size *= width
+    return tiers
+
+def fan_out(f, *args, **kwargs):
+    """
+    Runs f on the target hosts a tier at a time (see fan_out_tiers), FANOUT
+    wide. f gets the release onto the host, for which push_wheelhouse and
+    receive_artifact rsync from the host's relay in env.surge_relays rather
+    than from here. A host that failed relays to nobody, its hosts of the next
+    tier get pushed to directly, and it tries again when deployed.
+    """
+    width = int(getattr(env.deploy_settings, 'FANOUT', 0) or 0)
+    failed = set()
+
+    def relayed(*args, **kwargs):
+        try:
+            f(*args, **kwargs)
+        except (SystemExit, Exception) as e:
+            print red("{0} did not get the release: {1}".format(env.host_string, getattr(e, 'message', '') or e))
+            return False
+        return True
+    relayed.__name__ = f.__name__
+
+    for n, tier in enumerate(fan_out_tiers(target_hosts(), width)):
+        relays = dict((host, relay if relay not in failed else None) for host, relay in tier)
+        print cyan("Fan-out tier {0}: {1}".format(n + 1, ', '.join(
+            '{0} (from {1})'.format(h, relays[h]) if relays[h] else h for h, _ in tier)))
+        with settings(surge_hosts=[h for h, _ in tier], surge_relays=relays):
+            results = on_hosts(relayed, *args, **kwargs)
+        failed.update(h for h, result in results.items() if not result.get('result'))
+
+def relay_rsync(source, target, extra_opts=()):
+    """
+    Has the host rsync source from its relay in env.surge_relays (see fan_out)
+    to target, over FANOUT_SSH. Returns whether it did, False when there is no
+    relay or it failed.
+    """
+    relay = (env.get('surge_relays') or {}).get(env.host_string)
+    if not relay:
+        return False
+
+    user, host, port = normalize(relay)
+    say(cyan("Relaying {0} from {1}".format(source, relay)))
+    try:
+        with settings(forward_agent=True):
+            out = remote('mkdir -p {0} && rsync -rlptz --delete {1} -e "{2} -p {3}" {4}@{5}:{6} {0}'.format(
+                target, ' '.join(pipes.quote(o) for o in extra_opts),
+                getattr(env.deploy_settings, 'FANOUT_SSH', 'ssh -o BatchMode=yes'), port, user, host, source),
+                capture=True, warn_only=True)
+    except (SystemExit, Exception) as e:
+        say(yellow("Relaying from {0} failed ({1}), pushing directly".format(relay, getattr(e, 'message', '') or e)))
+        return False
+    if out.failed:
+        say(yellow("Relaying from {0} failed ({1}), pushing directly".format(relay, (out.strip().splitlines() or [out.return_code])[-1])))
+    return out.succeeded
+
+def rsync_from_host(remote_dir, local_dir, extra_opts=()):
+    """
+    rsyncs remote_dir on the host to local_dir, rsync_project the other way round
+    """
+    command = ssh_args(*ssh_options() if bool_opt('ssh_multiplex', {}) else [])
+    local('rsync -rlptz --delete {0} -e {1} {2}:{3} {4}'.format(
+        ' '.join(pipes.quote(o) for o in extra_opts), pipes.quote(' '.join(pipes.quote(a) for a in command[:-1])),
+        command[-1], remote_dir, pipes.quote(local_dir)))
+
+def changes_since(stamp):
+    """
+    Returns (HEAD, files changed since the commit recorded in the stamp state
+    file) from the host in one round-trip. The files are None when that commit
+    is not known (first run, or no longer in the repository).
+    """
+    with cd(project_path()):
+        out = remote('echo "@@head $(git rev-parse HEAD)"; prev=$(cat {0} 2>/dev/null); '
+                     'if [ -n "$prev" ] && git cat-file -e "$prev^{{commit}}" 2>/dev/null; '
+                     'then echo @@changed; git diff --name-only "$prev" HEAD; fi'.format(
+                         state_file(stamp)), capture=True, quiet=True)
+
+    head, changed = None, None
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith('@@head '):
+            head = line.split()[1]
+        elif line == '@@changed':
+            changed = []
+        elif changed is not None and line:
+            changed.append(line)
+    return head, changed
+
+def matches_setting(path, setting):
+    patterns = getattr(env.deploy_settings, setting, None) or []
+    return any(fnmatch.fnmatch(path, p) for p in patterns)
+
+def static_touches(changed, static_root_path):
+    """
+    Where the changed .less/.js files end up in STATIC_ROOT.
+
+    App static files (app/static/x/y.js) are collected as x/y.js, anything else
+    is taken to be in a STATICFILES_DIRS directory (assets/x/y.js) and so also
+    collected as x/y.js.
+    """
+    touches = []
+    for path in changed:
+        if not (path.endswith('.less') or path.endswith('.js')):
+            continue
+        if '/static/' in '/' + path:
+            collected = ('/' + path).rsplit('/static/', 1)[1]
+        elif '/' in path:
+            collected = path.split('/', 1)[1]
+        else:
+            continue
+        touches.append('{0}/{1}'.format(static_root_path.rstrip('/'), collected))
+    return touches
+
+def parse_diffsettings(out):
+    """
+    Will pick the settings out of ./manage.py diffsettings output into a dict.
+    Lines that are not NAME = python literal (ie. errors) are ignored.
+    """
+    found = {}
+    for line in out.splitlines():
+        m = re.match(r'^([A-Z][A-Z0-9_]*) = (.*?)(\s+###)?\s*$', line)
+        if not m:
+            continue
+        try:
+            found[m.group(1)] = ast.literal_eval(m.group(2))
+        except (ValueError, SyntaxError):
+            pass
+    return found
+
+def django_static_root():
+    """
+    The STATIC_ROOT of the project, from the settings when configured there.
+
+    Otherwise it is discovered with one diffsettings run and cached on the host
+    along with the settings module and the sha1 of its file, so it is only
+    discovered again once that file changes. Aborts when it can not be found.
+    Either way SETTINGS_MODULE and STATIC_ROOT are set on the deploy settings.
+    """
+    ds = env.deploy_settings
+    if getattr(ds, 'STATIC_ROOT', None):
+        return ds.STATIC_ROOT
+
+    cache = state_file('static_root')
+    with cd(project_path()):
+        out = remote('if [ -f {0} ]; then echo @@cache; cat {0}; f=$(sed -n 3p {0}); '
+                     'echo "@@sha1 $(sha1sum "$f" 2>/dev/null | cut -c1-40)"; fi'.format(cache),
+                     capture=True, quiet=True)
+        lines = [l.strip() for l in out.splitlines()]
+        lines = lines[lines.index('@@cache') + 1:] if '@@cache' in lines else []
+        if len(lines) >= 5 and lines[4] == '@@sha1 ' + lines[3]:
+            settings_module, static_root = lines[0], lines[1]
+        else:
+            print cyan("Discovering the settings module and STATIC_ROOT")
+            with prefix('source activate'):
+                found = parse_diffsettings(remote('./manage.py diffsettings --all',
+                                                  capture=True, quiet=True))
+            settings_module = ds.SETTINGS_MODULE or found.get('SETTINGS_MODULE')
+            static_root = found.get('STATIC_ROOT')
+            if not settings_module or not static_root:
+                abort(red("Could not discover the SETTINGS_MODULE/STATIC_ROOT of this project, "
+                          "set them in the deploy settings"))
+
+            settings_path = settings_module.replace('.', '/')
+            remote('if [ -f {0}.py ]; then f={0}.py; else f={0}/__init__.py; fi; '
+                   'mkdir -p {1} && printf "%s\\n" {2} {3} "$f" "$(sha1sum "$f" | cut -c1-40)" > {4}'.format(
+                       settings_path, state_file(''), pipes.quote(settings_module),
+                       pipes.quote(static_root), cache))
+
+    ds.update({'SETTINGS_MODULE': settings_module, 'STATIC_ROOT': static_root})
+    return static_root
+
+def record_commit(stamp, head):
+    """
+    Records head in the stamp state file for a later changes_since(stamp)
+    """
+    if head:
+        remote('mkdir -p {0} && echo {1} > {2}'.format(state_file(''), head, state_file(stamp)))
+
+def record_migrations(head, applied):
+    """
+    Records head in migrate.commit, like record_commit, and how many
+    migrations were applied to each database in migrate.applied ('?' for a
+    database migrated without planning), in the same round-trip
+    """
+    if head:
+        remote("mkdir -p {0} && printf '%s\\n' {1} > {2} && echo {3} > {4}".format(
+            state_file(''), ' '.join(pipes.quote('{0} {1}'.format(db, '?' if n is None else n))
+                                     for db, n in sorted(applied.items())),
+            state_file('migrate.applied'), head, state_file('migrate.commit')))
+
+PENDING_MIGRATIONS_SCRIPT = """
+from django.db import connections
+from django.db.migrations.executor import MigrationExecutor
+for db in {0!r}:
+    executor = MigrationExecutor(connections[db])
+    print('@@pending %s %d' % (db, len(executor.migration_plan(executor.loader.graph.leaf_nodes()))))
+"""
+
+def pending_migrations(databases):
+    """
+    Returns {database: number of unapplied migrations} with a single Django
+    boot for all the databases. A database is None when that could not be
+    worked out (ie. a Django without the migrations framework).
+    """
+    with cd(project_path()):
+        with prefix('source activate'):
+            out = remote("./manage.py shell <<'EOF'\n{0}\nEOF".format(
+                PENDING_MIGRATIONS_SCRIPT.format(list(databases))), capture=True, quiet=True)
+
+    pending = dict((db, None) for db in databases)
+    for line in out.splitlines():
+        m = re.search(r'@@pending (\S+) (\d+)', line)
+        if m and m.group(1) in pending:
+            pending[m.group(1)] = int(m.group(2))
+    return pending
+
+def extras_hash():
+    return hashlib.sha1(json.dumps(getattr(env.deploy_settings, 'EXTRA_COMMANDS', None) or [],
+                                   sort_keys=True)).hexdigest()
+
+def head_command():
+    """
+    Shell for the commit of the project, which for an artifact (no git repository)
+    build_artifact recorded
+    """
+    return '$(cat {0} 2>/dev/null || git rev-parse HEAD)'.format(state_file('artifact.commit'))
+
+def deploy_manifest():
+    """
+    Returns (HEAD, sha1 of the requirements files, the manifest of the last
+    deploy) from the host in one round-trip. The manifest is {} when there is
+    none.
+
+    With RELEASES=True HEAD and the requirements are those of the release in
+    hand (see project_path) but the manifest is always that of the live
+    release, DEPLOY_PATH/current.
+    """
+    manifest_file = state_file('manifest.json')
+    if bool_opt('releases', {}):
+        manifest_file = '{0}/current/{1}/manifest.json'.format(env.deploy_settings.DEPLOY_PATH,
+                                                               env.deploy_settings.SURGE_STATE_DIR)
+    with cd(project_path()):
+        out = remote('echo "@@head {0}"; echo "@@requirements $(cat {1} | sha1sum | cut -c1-40)"; '
+                     'echo @@manifest; cat {2} 2>/dev/null'.format(
+                         head_command(), ' '.join(requirements_files()), manifest_file),
+                     capture=True, quiet=True)
+
+    head, requirements, manifest = None, None, None
+    for line in out.splitlines():
+        if line.startswith('@@head '):
+            head = line.split()[1]
+        elif line.startswith('@@requirements '):
+            requirements = line.split()[1]
+        elif line == '@@manifest':
+            manifest = []
+        elif manifest is not None:
+            manifest.append(line)
+    try:
+        manifest = json.loads('\n'.join(manifest or []))
+    except ValueError:
+        manifest = {}
+    return head, requirements, manifest if isinstance(manifest, dict) else {}
+
+def check_deployed():
+    """
+    Works out if the host already had the checked out commit, the same
+    requirements and EXTRA_COMMANDS deployed, and so whether the
+    skip_if_deployed tasks can be skipped for the rest of this deploy.
+    """
+    if bool_opt('force_deploy', {}):
+        env.surge_unchanged = False
+        return False
+
+    head, requirements, manifest = deploy_manifest()
+    env.surge_manifest = manifest
+    env.surge_unchanged = bool(head) and \
+        manifest.get('commit') == head and \
+        manifest.get('requirements') == requirements and \
+        manifest.get('extras') == extras_hash()
+    if env.surge_unchanged:
+        say(green("{0} is already deployed (at {1}), skipping what has not changed".format(
+            head[:10], manifest.get('deployed_at'))))
+    return env.surge_unchanged
+
+def write_manifest():
+    """
+    Records what is now deployed on the host in SURGE_STATE_DIR/manifest.json
+    """
+    ds = env.deploy_settings
+    databases = ['default'] + list(getattr(ds, 'EXTRA_MIGRATE_FOR_DATABASES', None) or [])
+    cron_file = getattr(ds, 'CRON_FILE', None)
+    manifest = json.dumps({
+        'commit': head_command(),
+        'branch': getattr(ds, 'BRANCH_NAME', 'master'),
+        'requirements': '$(cat {0} 2>/dev/null)'.format(state_file('requirements.sha1')),
+        'static': '$(cat {0} 2>/dev/null)'.format(state_file('static.commit')),
+        'migrations': {
+            'commit': '$(cat {0} 2>/dev/null)'.format(state_file('migrate.commit')),
+            # What the last migrate applied to each database (see record_migrations)
+            'applied': dict((db, "$(sed -n 's/^{0} //p' {1} 2>/dev/null)".format(db, state_file('migrate.applied')))
+                            for db in databases),
+        },
+        'crontab': '$([ -f {0} ] && sha1sum < {0} | cut -c1-40)'.format(cron_file) if cron_file else '',
+        'extras': extras_hash(),
+        'deployed_at': '$(date -u +%Y-%m-%dT%H:%M:%SZ)',
+        'deployed_by': env.local_user,
+    }, indent=2, sort_keys=True)
+
+    with cd(project_path()):
+        remote('mkdir -p {0} && cat > {1}.tmp <<EOF && mv {1}.tmp {1}\n{2}\nEOF'.format(
+            state_file(''), state_file('manifest.json'), manifest))
+
 @task
+@timed
 def sudo_check():
     print cyan("Validating sudo.")
-    result = sudo('echo "Got it!"')
+    result = remote('echo "Got it!"', use_sudo=True, capture=True)
     if result:
         return True
     else:
@@ -200,7 +1670,43 @@ def sudo_check():
         return False
 
 @task
-def show_settings():
+def target(*selection):
+    """
+    Selects the deploy target(s) for the tasks after it, by name, fnmatch
+    pattern or tag:name (see use_targets), ie. fab deploy.target:tag:web deploy
+
+    surge_stack and fleet tasks (full_deploy, bounce_services, ...) run against
+    each of them in turn, other tasks only against the first.
+    """
+    if not env.get('deploy_targets'):
+        abort(red("No deploy targets, see use_targets"))
+    env.surge_targets = env.deploy_targets.select(';'.join(selection))
+    select_target(env.deploy_targets, env.surge_targets[0])
+    print cyan("Target(s): {0}".format(', '.join(env.surge_targets)))
+
+@task
+def targets(*args, **kwargs):
+    """
+    Lists the deploy targets and their tags (see use_targets)
+
+    :tag=name only lists those with the tag
+    """
+    if not env.get('deploy_targets'):
+        abort(red("No deploy targets, see use_targets"))
+    for name in env.deploy_targets.names():
+        tags = env.deploy_targets.declared(name)['tags']
+        if kwargs.get('tag') and kwargs['tag'] not in tags:
+            continue
+        print "{0:<30} {1}".format(name, ', '.join(tags))
+
+@task
+@timed
+def show_settings(*args, **kwargs):
+    """
+    Will display the deployment targets configured settings
+
+    :manifest=True also shows what is deployed on the host(s)
+    """
     print "\n({0} {1} {2})\n".format(cyan('Configured'),
                                      green('Default'),
                                      magenta('Overridden Default'))
@@ -211,8 +1717,19 @@ def show_settings():
             outcolor = green if v == DEFAULT_SETTINGS[s] else magenta
 
         print outcolor("{0} = {1}".format(s, v))
-        
+
+    if bool_opt('manifest', kwargs):
+        results = on_hosts(host_manifest)
+        for host in target_hosts():
+            print ""
+            print blue("Deployed on {0}:".format(host))
+            pprint(results[host].get('result') or 'Nothing recorded')
+
+def host_manifest(*args, **kwargs):
+    return deploy_manifest()[2]
+
 @task
+@timed
 @skip_if_not('REQUIRE_CLEAN')
 def is_local_clean(*args, **kwargs):
     """
@@ -230,24 +1747,27 @@ def is_local_clean(*args, **kwargs):
     return not has_changes
 
 @task
+@timed
 @skip_if_not('REQUIRE_REMOTE_CLEAN')
 def is_remote_clean(*args, **kwargs):
     """
     Checks that the remote git work area is clean or not
 
     runs:
-    git --work-tree=DEPLOY_PATH --git-dir=DEPLOY_PATH/.git status --porcelain
+    git --work-tree=GIT_TREE --git-dir=GIT_TREE/.git status --porcelain
     """
 
     print cyan("Ensuring remote working area is clean...")
-    git_cmd = "git --work-tree={0} --git-dir={0}/.git".format(env.deploy_settings.DEPLOY_PATH)
-    has_changes = run(git_cmd + " status --porcelain")
+    git_cmd = "git --work-tree={0} --git-dir={0}/.git".format(env.deploy_settings.GIT_TREE)
+    has_changes = remote(git_cmd + " status --porcelain", capture=True)
     if has_changes:
         abort(red("Remote working directory is not clean."))
 
     return not has_changes
 
 @task
+@timed
+@skip_if_deployed
 def fix_ownerships(*args, **kwargs):
     """
     Ensure the project files have the USER:GROUP ownership
@@ -256,17 +1776,30 @@ def fix_ownerships(*args, **kwargs):
     chown USER:GROUP -R *
     chown USER:GROUP -R .git*
     chown USER:GROUP -R .env|env (if these exist)
+
+    or with INCREMENTAL_OWNERSHIPS=True, only for what is not owned right:
+    find * .git* .env env ! -user USER -o ! -group GROUP -exec chown -h USER:GROUP
     """
 
-    with cd(env.deploy_settings.DEPLOY_PATH):
-        print cyan('Fixing project ownerships')
-        sudo('chown %s -R *' % env.deploy_settings.CHOWN_TARGET)
-        sudo('chown %s -R .git*' % env.deploy_settings.CHOWN_TARGET)
-        sudo('if [ -e .env ]; then chown %s -R .env; fi' % env.deploy_settings.CHOWN_TARGET)
-        sudo('if [ -e env ]; then chown %s -R env; fi' % env.deploy_settings.CHOWN_TARGET)
-        print ""
+    with cd(project_path()):
+        if bool_opt('incremental_ownerships', kwargs, default=False):
+            owner, group = env.deploy_settings.CHOWN_TARGET.split(':', 1)
+            say(cyan('Fixing project ownerships (incremental)'))
+            remote('find * .git* $(ls -d .env env 2>/dev/null) \\( ! -user {0} -o ! -group {1} \\) '
+                   '-exec chown -h {2} {{}} +'.format(owner, group, env.deploy_settings.CHOWN_TARGET),
+                   use_sudo=True)
+            say("")
+            return None
+
+        say(cyan('Fixing project ownerships'))
+        remote('chown %s -R *' % env.deploy_settings.CHOWN_TARGET, use_sudo=True)
+        remote('chown %s -R .git*' % env.deploy_settings.CHOWN_TARGET, use_sudo=True)
+        remote('if [ -e .env ]; then chown %s -R .env; fi' % env.deploy_settings.CHOWN_TARGET, use_sudo=True)
+        remote('if [ -e env ]; then chown %s -R env; fi' % env.deploy_settings.CHOWN_TARGET, use_sudo=True)
+        say("")
 
 @task
+@timed
 @can_override_settings
 def pull(*args, **kwargs):
     """
@@ -277,15 +1810,294 @@ def pull(*args, **kwargs):
     git checkout {branch from settings or supplied}
     git pull
 
-    :branch= sets the desired branch
+    or with FAST_FETCH=True, fetching just the branch and resetting to it:
+    git fetch [--depth FETCH_DEPTH] [--filter FETCH_FILTER] GIT_REMOTE branch &&
+        git checkout -B branch GIT_REMOTE/branch
+
+    :branch= sets the desired branch
+    """
+
+    ds = env.deploy_settings
+    branch = getattr(ds, 'BRANCH_NAME', 'master')
+    say(cyan("Pulling from {0}".format(branch)))
+    with cd(ds.GIT_TREE):
+        if bool_opt('fast_fetch', kwargs, default=False):
+            options = ''
+            if ds.FETCH_DEPTH:
+                options += ' --depth {0}'.format(int(ds.FETCH_DEPTH))
+            if ds.FETCH_FILTER:
+                options += ' --filter={0}'.format(ds.FETCH_FILTER)
+            remote('git fetch -q{0} {1} +refs/heads/{2}:refs/remotes/{1}/{2} && '
+                   'git checkout -q -B {2} {1}/{2}'.format(options, ds.GIT_REMOTE, branch))
+            return None
+
+        remote('git fetch')
+        remote('git checkout {0}'.format(branch))
+        remote('git pull')
+
+@task
+@timed
+def build_release(*args, **kwargs):
+    """
+    With RELEASES=True, sets up DEPLOY_PATH/releases/<commit> for the commit
+    checked out in GIT_TREE (unless already there) and makes it the project
+    the following tasks work on. Does nothing otherwise.
+
+    runs:
+    git clone --shared GIT_TREE releases/<commit>
+    RELEASE_VENV_COMMAND
+    ln -s DEPLOY_PATH/shared/<path> <path> for the RELEASE_SHARED_PATHS
+    """
+
+    if not bool_opt('releases', kwargs):
+        return None
+
+    ds = env.deploy_settings
+    path = release_path(repo_head())
+    # What still holds for the new release, the rest it works out for itself
+    keep = ['migrate.commit', 'migrate.applied', 'syncdb.commit', 'wheelhouse']
+    if not ds.RELEASE_VENV_COMMAND:
+        keep.append('requirements.sha1')
+
+    # Marks the release until it is set up, so one left half-built is built again
+    partial = '{0}/{1}/release.partial'.format(path, ds.SURGE_STATE_DIR)
+
+    steps = ['rm -rf {0} {0}.tmp'.format(path),
+             'git clone -q --shared --no-checkout {0} {1}.tmp'.format(ds.GIT_TREE, path),
+             'cd {0}.tmp'.format(path),
+             'git checkout -q {0}'.format(path.rsplit('/', 1)[1]),
+             'mkdir -p {0} && touch {0}/release.partial'.format(ds.SURGE_STATE_DIR)]
+    steps.append('for f in {1}; do if [ -e ../../current/{0}/$f ]; then '
+                 'cp -a ../../current/{0}/$f {0}/; fi; done'.format(ds.SURGE_STATE_DIR, ' '.join(keep)))
+    # The virtualenv is made in its final place, it does not survive a move
+    steps.append('cd .. && mv {0}.tmp {0} && cd {0}'.format(path))
+    if ds.RELEASE_VENV_COMMAND:
+        steps.append(ds.RELEASE_VENV_COMMAND)
+    for shared in ds.RELEASE_SHARED_PATHS:
+        steps.append('mkdir -p $(dirname {0}/shared/{1}) && rm -rf {1} && ln -sfn {0}/shared/{1} {1}'.format(
+            ds.DEPLOY_PATH, shared))
+    steps.append('rm {0}'.format(partial))
+
+    say(cyan("Preparing release {0}".format(path)))
+    # Touched when reused so the newest releases are the ones kept
+    remote('if [ -d {0} ] && [ ! -e {1} ]; then touch {0}; else (set -e\n{2}\n); fi'.format(
+        path, partial, '\n'.join(steps)))
+    say("")
+    env.surge_release = path
+    return path
+
+@task
+@timed
+def switch_release(*args, **kwargs):
+    """
+    Points DEPLOY_PATH/current at the release of the commit checked out in
+    GIT_TREE in one atomic rename, and DEPLOY_PATH/previous at the release
+    it replaced.
+
+    runs:
+    ln -sfn releases/<commit> current.new && mv -T current.new current
+    """
+
+    if not bool_opt('releases', kwargs):
+        return None
+
+    release = 'releases/' + repo_head()
+    say(cyan("Switching to {0}".format(release)))
+    with cd(env.deploy_settings.DEPLOY_PATH):
+        out = remote('[ -d {0} ] || {{ echo "No {0}"; exit 1; }}; old=$(readlink current); ln -sfn {0} current.new && mv -T current.new current || exit 1; '
+                     'if [ "$old" != {0} ]; then echo @@switched; if [ -n "$old" ]; then ln -sfn "$old" previous; fi; fi'.format(release),
+                     capture=True, quiet=True)
+    if out.failed:
+        abort(red("Could not switch to {0}: {1}".format(release, out)))
+    say("")
+    env.surge_release = None
+    if '@@switched' in out.splitlines():
+        # New code went live, whatever check_deployed made of it the services must be bounced
+        env.surge_unchanged = False
+
+@task
+@timed
+def prune_releases(*args, **kwargs):
+    """
+    Removes all but the KEEP_RELEASES newest releases, never the current or
+    previous one
+
+    runs:
+    ls -1t releases | tail -n +KEEP_RELEASES+1 | xargs rm -rf
+    """
+
+    if not bool_opt('releases', kwargs):
+        return None
+
+    keep = max(int(getattr(env.deploy_settings, 'KEEP_RELEASES', 5) or 1), 1)
+    say(cyan("Keeping the {0} newest releases".format(keep)))
+    with cd(env.deploy_settings.DEPLOY_PATH + '/releases'):
+        remote('ls -1t | tail -n +{0} | grep -v -x -e "$(basename "$(readlink ../current)")" '
+               '-e "$(basename "$(readlink ../previous)")" | xargs -r rm -rf'.format(keep + 1),
+               use_sudo=True)
+    say("")
+
+@task
+@fleet
+@timed
+def rollback(*args, **kwargs):
+    """
+    Points DEPLOY_PATH/current back at the previous release and bounces the
+    services. Migrations are not reversed.
+
+    runs:
+    ln -sfn $(readlink previous) current.new && mv -T current.new current
+    bounce_services
+    """
+
+    if not bool_opt('releases', kwargs):
+        abort(red("rollback needs RELEASES=True"))
+
+    print cyan("Rolling back to the previous release")
+    with cd(env.deploy_settings.DEPLOY_PATH):
+        remote('[ -L previous ] || { echo "No previous release"; exit 1; }; old=$(readlink current); '
+               'ln -sfn "$(readlink previous)" current.new && mv -T current.new current && '
+               'ln -sfn "$old" previous')
+    env.surge_release = None
+    bounce_services(*args, **kwargs)
+
+@task
+@timed
+def build_artifact(*args, **kwargs):
+    """
+    With RELEASES=True, builds the release of the branch once on
+    ARTIFACT_BUILD_HOST (the first host by default) and rsyncs it, but for the
+    git repository, to LOCAL_ARTIFACTS/<commit> for receive_artifact to push to
+    the hosts. The database is migrated from the build host too.
+
+    runs on the build host:
+    is_remote_clean, pull, build_release, update_submodules,
+    install_requirements, collectstatic, sync_db, run_migrations
+    """
+
+    if not bool_opt('releases', kwargs):
+        abort(red("ARTIFACT needs RELEASES=True"))
+
+    ds = env.deploy_settings
+    build_host = getattr(ds, 'ARTIFACT_BUILD_HOST', None) or target_hosts()[0]
+    env.surge_artifact = None
+    print cyan("Building the artifact on {0}".format(build_host))
+    with settings(host_string=build_host, surge_on_host=True, surge_release=None, surge_unchanged=None,
+                  surge_manifest=None):
+        is_remote_clean()
+        pull()
+        build_release()
+        update_submodules()
+        install_requirements()
+        collectstatic()
+        sync_db()
+        run_migrations()
+
+        head = repo_head()
+        release = env.surge_release
+        with cd(release):
+            out = remote('mkdir -p {0} && echo {1} > {2} && sum=$({3}) && echo $sum > {4} && echo "@@artifact $sum"'.format(
+                state_file(''), head, state_file('artifact.commit'), ARTIFACT_CHECKSUM, state_file('artifact.sha1')),
+                capture=True, quiet=True)
+        checksum = None
+        for line in out.splitlines():
+            if line.startswith('@@artifact ') and len(line.split()) > 1:
+                checksum = line.split()[1]
+        if not checksum:
+            abort(red("Could not checksum the artifact in {0}".format(release)))
+
+        artifacts = artifacts_dir()
+        path = os.path.join(artifacts, head)
+        if not os.path.isdir(artifacts):
+            os.makedirs(artifacts)
+        fetched = None
+        if os.path.isdir(path) and os.path.exists(path + '.sha1'):
+            with open(path + '.sha1') as f:
+                fetched = f.read().strip()
+
+        if fetched == checksum:
+            os.utime(path, None)
+        else:
+            print cyan("Fetching the artifact to {0}".format(path))
+            opts = artifact_filters()
+            # The newest artifact is the basis for the delta transfer
+            others = sorted([os.path.join(artifacts, a) for a in os.listdir(artifacts)
+                             if a != head and os.path.isdir(os.path.join(artifacts, a))], key=os.path.getmtime)
+            if others:
+                opts.append('--copy-dest={0}/'.format(os.path.abspath(others[-1])))
+            rsync_from_host(release + '/', path + '.tmp/', opts)
+            fetched = tree_checksum(path + '.tmp')
+            if fetched != checksum:
+                abort(red("The fetched artifact does not match its checksum ({0} instead of {1})".format(
+                    fetched, checksum)))
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(path + '.tmp', path)
+            with open(path + '.sha1', 'w') as f:
+                f.write(checksum + '\n')
+
+    keep = max(int(getattr(ds, 'KEEP_RELEASES', 5) or 1), 1)
+    old = sorted([os.path.join(artifacts, a) for a in os.listdir(artifacts)
+                  if os.path.isdir(os.path.join(artifacts, a)) and not a.endswith('.tmp')],
+                 key=os.path.getmtime)[:-keep]
+    for stale in old:
+        shutil.rmtree(stale, ignore_errors=True)
+        if os.path.exists(stale + '.sha1'):
+            os.remove(stale + '.sha1')
+
+    env.surge_artifact = {'commit': head, 'checksum': checksum, 'path': path}
+    print ""
+    return env.surge_artifact
+
+@task
+@timed
+def receive_artifact(*args, **kwargs):
+    """
+    With ARTIFACT=True, rsyncs the artifact of build_artifact to
+    DEPLOY_PATH/releases/<commit>, with the current release as the basis for
+    the delta transfer, checks it against its checksum and makes it the
+    project the following tasks work on. A release already there with the
+    same checksum is reused. Does nothing otherwise.
     """
 
-    branch = getattr(env.deploy_settings, 'BRANCH_NAME', 'master')
-    print cyan("Pulling from {0}".format(branch))
-    with cd(env.deploy_settings.DEPLOY_PATH):
-        run('git fetch')
-        run('git checkout {0}'.format(branch))
-        run('git pull')
+    if not bool_opt('artifact', kwargs):
+        return None
+
+    artifact = env.get('surge_artifact')
+    if not artifact:
+        abort(red("No artifact to deploy, see build_artifact"))
+
+    ds = env.deploy_settings
+    path = release_path(artifact['commit'])
+    state = '{0}/{1}'.format(path, ds.SURGE_STATE_DIR)
+    # artifact.sha1 marks a release received in full, it is not transferred but written once checked
+    out = remote('if [ "$(cat {0}/artifact.sha1 2>/dev/null)" = {1} ]; then touch {2}; echo @@artifact present; '
+                 'else rm -f {0}/artifact.sha1; if [ -d {3}/current/ ]; then echo @@artifact current; fi; fi'.format(
+                     state, artifact['checksum'], path, ds.DEPLOY_PATH), capture=True, quiet=True)
+
+    if '@@artifact present' not in out:
+        # Straight into the release, the virtualenv in it does not survive a move
+        opts = ['--exclude=/{0}/artifact.sha1'.format(ds.SURGE_STATE_DIR.strip('/'))] + artifact_filters()
+        if '@@artifact current' in out:
+            opts.append('--copy-dest={0}/current/'.format(ds.DEPLOY_PATH))
+        if not relay_rsync(path + '/', path + '/', opts):
+            say(cyan("Pushing artifact {0}".format(artifact['commit'])))
+            opts = [pipes.quote(o) for o in opts]
+            opts.append('--rsync-path="mkdir -p {0} && rsync"'.format(path))
+            rsync_project(remote_dir=path + '/', local_dir=artifact['path'] + '/', delete=True,
+                          default_opts='-rlptz', extra_opts=' '.join(opts),
+                          ssh_opts=' '.join(ssh_options()) if bool_opt('ssh_multiplex', {}) else '')
+
+        with cd(path):
+            out = remote('echo "@@artifact $({0})"'.format(ARTIFACT_CHECKSUM), capture=True, quiet=True)
+        received = [line.split()[1] for line in out.splitlines() if line.startswith('@@artifact ')]
+        if received != [artifact['checksum']]:
+            abort(red("The artifact pushed to {0} does not match its checksum ({1} instead of {2})".format(
+                env.host_string, ', '.join(received) or 'none', artifact['checksum'])))
+        remote('mkdir -p {0} && echo {1} > {0}/artifact.sha1'.format(state, artifact['checksum']))
+        say("")
+
+    env.surge_release = path
+    return path
 
 @task
 @surge_stack
@@ -301,12 +2113,15 @@ def full_pull(*args, **kwargs):
 
     :branch= sets the desired branch
     """
-    fix_ownerships()
-    pull()
-    update_submodules()
-    fix_ownerships()
+    with batched('full_pull'):
+        fix_ownerships()
+        pull()
+        update_submodules()
+        fix_ownerships()
 
 @task
+@timed
+@skip_if_deployed
 def update_submodules(*args, **kwargs):
     """
     Init and update the git submodules for the project
@@ -314,155 +2129,624 @@ def update_submodules(*args, **kwargs):
     runs:
     git submodule init
     git submodule update
+
+    or with SUBMODULE_JOBS above 1, updating that many submodules at a time:
+    git submodule update --init --jobs SUBMODULE_JOBS
     """
-    with cd(env.deploy_settings.DEPLOY_PATH):
-            print cyan('Initializing submodules')
-            run('git submodule init')
-            print ""
+    jobs = int(getattr(env.deploy_settings, 'SUBMODULE_JOBS', 1) or 1)
+    with cd(project_path()):
+        if jobs > 1:
+            say(cyan('Updating submodules ({0} at a time)'.format(jobs)))
+            remote('git submodule update --init --jobs {0}'.format(jobs))
+            say("")
+            return None
 
-            print cyan('Updating submodules')
-            run('git submodule update')
-            print ""
+        say(cyan('Initializing submodules'))
+        remote('git submodule init')
+        say("")
+
+        say(cyan('Updating submodules'))
+        remote('git submodule update')
+        say("")
 
 @task
+@timed
 def fix_logfile_permissions(*args, **kwargs):
     """
     Sets the correct file permissions on the files in the LOG_PATH
 
     runs:
     chmod --preserve-root --changes a+r,ug+w -R LOGS_PATH
+
+    or with INCREMENTAL_OWNERSHIPS=True, only for what is missing those permissions:
+    find LOGS_PATH ! -perm -a+r,ug+w -exec chmod --changes a+r,ug+w
     """
 
-    with cd(env.deploy_settings.DEPLOY_PATH):
+    with cd(project_path()):
         if getattr(env.deploy_settings, 'LOGS_PATH', False):
-            print cyan("Ensuring proper permissions on log files (-rw-rw-r--)")
-            sudo("chmod --preserve-root --changes a+r,ug+w -R %s" % env.deploy_settings.LOGS_PATH)
-            print ""
+            say(cyan("Ensuring proper permissions on log files (-rw-rw-r--)"))
+            if bool_opt('incremental_ownerships', kwargs, default=False):
+                remote("find %s ! -perm -a+r,ug+w -exec chmod --changes a+r,ug+w {} +" % env.deploy_settings.LOGS_PATH,
+                       use_sudo=True)
+            else:
+                remote("chmod --preserve-root --changes a+r,ug+w -R %s" % env.deploy_settings.LOGS_PATH, use_sudo=True)
+            say("")
 
 @task
+@timed
+@skip_if_deployed
 def install_requirements(*args, **kwargs):
     """
     Installs the project's requirements from the project's requirements.txt file
     into the project's activated virtual environment.
+    Skipped when the requirements files have not changed since the last
+    successful install on the host.
+
+    With WHEELHOUSE=True the requirements are installed from the local
+    wheelhouse (see build_wheelhouse) pushed to the host instead of the index.
 
     runs:
     pip install -r requirements.txt
+
+    :force_requirements=True will install even if unchanged
     """
 
-    with cd(env.deploy_settings.DEPLOY_PATH):
+    files = requirements_files()
+    current, recorded = requirements_hashes()
+    if not bool_opt('force_requirements', kwargs, default=False):
+        if current and current == recorded:
+            say(green("Requirements unchanged, skipping install ({0})".format(current[:10])))
+            return None
+
+    find_links = ''
+    if bool_opt('wheelhouse', kwargs, default=False):
+        if current == local_requirements_hash():
+            find_links = '--no-index --find-links {0} '.format(push_wheelhouse(build_wheelhouse()))
+        else:
+            say(yellow("The host's requirements differ from the local ones, installing from the index"))
+
+    with cd(project_path()):
         with prefix("source activate"):
-            print cyan("Installing from requirements.txt")
-            run("pip install -r requirements.txt")
+            say(cyan("Installing from {0}".format(', '.join(files))))
+            remote("pip install {0}{1}".format(find_links, ' '.join('-r ' + f for f in files)))
+            # Only reached when pip succeeded
+            remote('mkdir -p {0} && cat {1} | sha1sum | cut -c1-40 > {2}'.format(
+                state_file(''), ' '.join(files), state_file('requirements.sha1')))
+
+@task
+@timed
+@skip_if_deployed
+def precompile(*args, **kwargs):
+    """
+    Compiles the .py files of the project and its virtualenv ahead of bouncing
+    the services, PRECOMPILE_JOBS processes at a time (0 for one per cpu), so
+    the restarted workers do not have to. Files already compiled are skipped.
+
+    runs:
+    find . $VIRTUAL_ENV -name "*.py" | xargs -P PRECOMPILE_JOBS python -m compileall -q
+    """
+
+    jobs = int(getattr(env.deploy_settings, 'PRECOMPILE_JOBS', 0) or 0)
+    with cd(project_path()):
+        with prefix('source activate'):
+            say(cyan("Compiling the project and virtualenv"))
+            # The virtualenv is in the project with RELEASES, it needs no second go
+            remote('dirs=.; case "$VIRTUAL_ENV" in ""|"$(pwd -P)"/*|"$(pwd)"/*) ;; *) dirs=". $VIRTUAL_ENV";; esac; '
+                   'find $dirs -name "*.py" -not -path "./.git/*" -print0 | '
+                   'xargs -0 -r -n 200 -P {0} python -m compileall -q > /dev/null 2>&1; true'.format(
+                       jobs or '$(nproc)'))
+            say("")
 
 @task
+@timed
+def build_wheelhouse(*args, **kwargs):
+    """
+    Builds wheels of the requirements into LOCAL_WHEELHOUSE/<requirements sha1>
+
+    Reuses the wheelhouse already built for the same requirements.
+    Runs locally with WHEELHOUSE_PIP, which must build for the hosts' platform.
+    """
+
+    path = wheelhouse_dir()
+    if os.path.exists(os.path.join(path, '.complete')):
+        print green("Wheelhouse up to date ({0})".format(path))
+        return path
+
+    print cyan("Building wheelhouse {0}".format(path))
+    local("{0} wheel --wheel-dir {1} {2}".format(
+        getattr(env.deploy_settings, 'WHEELHOUSE_PIP', 'pip'), path,
+        ' '.join('-r ' + f for f in requirements_files())))
+    # Only reached when every wheel was built
+    open(os.path.join(path, '.complete'), 'w').close()
+    return path
+
+def receive_wheelhouse(*args, **kwargs):
+    """
+    Gets the wheelhouse onto the host ahead of install_requirements (see fan_out)
+    """
+    with cd(project_path()):
+        return push_wheelhouse(wheelhouse_dir())
+
+@task
+@timed
+def check_requirements(*args, **kwargs):
+    """
+    Reports which hosts would pip install on their next deploy
+
+    Compares the hash of the local requirements files against the hash every
+    host recorded at its last install, all hosts in one parallel pass.
+    """
+
+    wanted = local_requirements_hash()
+    print cyan("Local requirements hash {0}".format(wanted[:10]))
+    results = on_hosts(recorded_requirements_hash)
+    for host in target_hosts():
+        recorded = results[host].get('result')
+        if recorded == wanted:
+            print green("{0}: requirements up to date".format(host))
+        else:
+            print yellow("{0}: will install requirements (recorded {1})".format(host, (recorded or 'nothing')[:10]))
+
+@task
+@timed
+@skip_if_deployed
 @needs_django
 def collectstatic(*args, **kwargs):
     """
     Collect static assets for a Django project
 
+    Only runs when files matching STATIC_INPUT_PATTERNS changed since the
+    commit static was last collected for, and then only touches the changed
+    .less/.js files so the compressor does not rebuild its whole cache.
+
     runs:
     manage.py collectstatic -v0 --noinput
+
+    :force_collectstatic=True will collect and touch everything
     """
 
-    print cyan("Collecting static resources")
-    with cd(env.deploy_settings.DEPLOY_PATH):
+    head, changed = changes_since('static.commit')
+    if bool_opt('force_collectstatic', kwargs, default=False):
+        changed = None
+    if changed is not None:
+        changed = [f for f in changed if matches_setting(f, 'STATIC_INPUT_PATTERNS')]
+        if not changed:
+            say(green("No static inputs changed, skipping collectstatic"))
+            record_commit('static.commit', head)
+            return None
+
+    say(cyan("Collecting static resources"))
+    with cd(project_path()):
         with prefix('source activate'):
             # Setting verbose to minimal outupt
             # We aren't going to prompt if we really want to collectstatic
-            run("./manage.py collectstatic -v0 --noinput")
-
-            # Get the settings module
-            out = run("./manage.py diffsettings --all | grep SETTINGS_MODULE")
-            split_sm = out.split("=")
-            sm = None
-            if len(split_sm) > 1:
-                # Sometimes ./manage.py throws errors that end up in this output
-                re_split_sm = re.split(r'(\n|\r|\r\n)', split_sm[1])[0]
-                # Get the settings module
-                m = re.search(r'[\'|\"].*?[\'|\"]', re_split_sm)
-                sm = m.group().strip() if m else None
-
-            # Get the STATIC_ROOT path
-            srp = run("python -c 'from {0} import STATIC_ROOT; print STATIC_ROOT'".format(sm))
-            static_root_path = srp if srp else 'collected-assets'
+            remote("./manage.py collectstatic -v0 --noinput")
+
+            static_root_path = django_static_root()
 
             # Touch the .less/.js files in STATIC_ROOT
-            if exists(static_root_path):
-                print cyan('Touching *.less and *.js in {0}'.format(static_root_path))
-                # Exclude the _cache directory used by Compress
-                run('find {0} \( -name "*.less" -or -name "*.js" \) -not -path "*/_cache*/*" -exec touch {{}} +'.format(static_root_path))
+            if remote('test -e {0}'.format(static_root_path), capture=True, quiet=True).succeeded:
+                if changed is None:
+                    say(cyan('Touching *.less and *.js in {0}'.format(static_root_path)))
+                    # Exclude the _cache directory used by Compress
+                    remote('find {0} \( -name "*.less" -or -name "*.js" \) -not -path "*/_cache*/*" -exec touch {{}} +'.format(static_root_path))
+                else:
+                    touches = static_touches(changed, static_root_path)
+                    if touches:
+                        say(cyan('Touching {0} changed *.less and *.js in {1}'.format(len(touches), static_root_path)))
+                        # -c so files that did not end up where expected are not created
+                        remote('touch -c {0}'.format(' '.join(pipes.quote(t) for t in touches)))
                 # Only fix the ownerships if collectstatic is called from the command line
                 if not env.surge_stack:
-                    sudo('chown {0} -R {1}'.format(env.deploy_settings.CHOWN_TARGET,
-                                                   static_root_path))
-                print ""
+                    remote('chown {0} -R {1}'.format(env.deploy_settings.CHOWN_TARGET,
+                                                     static_root_path), use_sudo=True)
+                say("")
             else:
                 print red('Could not locate the STATIC_ROOT path for this project, skipping touches.\n')
 
+    record_commit('static.commit', head)
 
 
 @task
+@timed
+@skip_if_deployed
 @needs_django
 @skip_if_not('SKIP_MIGRATE', False)
 def run_migrations(*args, **kwargs):
     """
     Runs the Django manaagement command migrate for DJANGO_PROJECT=True
 
+    Skipped when no file matching MIGRATION_INPUT_PATTERNS changed since the
+    last migrate. Otherwise the pending migrations of every database are
+    planned with one Django boot and only the databases with something to
+    apply are migrated, MIGRATE_PARALLELISM of the extra databases at a time.
+
     runs:
     manage.py migrate
+    manage.py migrate --database X (where X is each database of EXTRA_MIGRATE_FOR_DATABASES)
+
+    :force_migrate=True will migrate every database without planning
     """
 
-    print cyan("Running migrations")
-    with cd(env.deploy_settings.DEPLOY_PATH):
-        with prefix('source activate'):
-            run("./manage.py migrate")
+    extra_migrations = getattr(env.deploy_settings, 'EXTRA_MIGRATE_FOR_DATABASES', None) or []
+    databases = ['default'] + list(extra_migrations)
+
+    head, changed = changes_since('migrate.commit')
+    if bool_opt('force_migrate', kwargs, default=False):
+        pending = dict((db, None) for db in databases)
+    else:
+        if changed is not None and not [f for f in changed if matches_setting(f, 'MIGRATION_INPUT_PATTERNS')]:
+            say(green("No migration changes, skipping migrations"))
+            record_migrations(head, dict((db, 0) for db in databases))
+            return None
+        pending = pending_migrations(databases)
+
+    if pending['default'] == 0:
+        say(green("No migrations to apply"))
+    else:
+        say(cyan("Running migrations"))
+        with cd(project_path()):
+            with prefix('source activate'):
+                remote("./manage.py migrate")
 
-    extra_migrations = getattr(env.deploy_settings, 'EXTRA_MIGRATE_FOR_DATABASES', [])
+    extra_migrations = [db for db in extra_migrations if pending[db] != 0]
     if extra_migrations:
-        print ""
-        print cyan("Running extra migrations")
-        with cd(env.deploy_settings.DEPLOY_PATH):
+        say("")
+        say(cyan("Running extra migrations"))
+        parallelism = int(getattr(env.deploy_settings, 'MIGRATE_PARALLELISM', 1) or 1)
+        with cd(project_path()):
             with prefix('source activate'):
-                for db in extra_migrations:
-                    run("./manage.py migrate --database {}".format(db))
+                if parallelism > 1 and len(extra_migrations) > 1:
+                    # Each database's output is prefixed with its name, xargs fails if any migrate did
+                    remote("printf '%s\\n' {0} | xargs -P {1} -I{{}} bash -c "
+                           "'set -o pipefail; ./manage.py migrate --database \"$0\" 2>&1 | sed \"s/^/[$0] /\"' {{}}".format(
+                               ' '.join(pipes.quote(db) for db in extra_migrations), parallelism))
+                else:
+                    for db in extra_migrations:
+                        remote("./manage.py migrate --database {}".format(db))
+
+    record_migrations(head, pending)
 
 
 @task
+@timed
+@skip_if_deployed
 def run_extras(*args, **kwargs):
     """
     Runs any extra commands on HOST in EXTRA_COMMANDS list of the settings
+
+    When some are declared as dicts (see plan_extras) they are run
+    EXTRA_CONCURRENCY at a time as their dependencies allow, in one activated
+    shell on the host (see run_extras_concurrently).
     """
 
-    with cd(env.deploy_settings.DEPLOY_PATH):
+    extras = getattr(env.deploy_settings, 'EXTRA_COMMANDS', None) or []
+    with cd(project_path()):
         with prefix('source activate'):
-            for cmd in getattr(env.deploy_settings, 'EXTRA_COMMANDS', []):
-                print cyan('Extra:  ' + cmd)
-                run(cmd)
+            if any(isinstance(e, dict) for e in extras):
+                run_extras_concurrently(plan_extras(extras))
+                return
+            for cmd in extras:
+                say(cyan('Extra:  ' + cmd))
+                remote(cmd)
+
+def plan_extras(extras):
+    """
+    Orders the EXTRA_COMMANDS into waves, each of extras only depending on
+    extras of earlier waves.
+
+    A dict entry is {'command': ..., 'name': ..., 'after': [names], 'timeout': seconds},
+    all but the command optional. The dicts between two strings run at the
+    same time unless one comes after another. A string stays a step of its
+    own: it runs after everything before it, everything after it waits for it.
+    """
+    entries, names, barrier = [], {}, set()
+    for i, extra in enumerate(extras):
+        entry = dict(extra) if isinstance(extra, dict) else {'command': extra}
+        if not entry.get('command'):
+            abort(red("EXTRA_COMMANDS entry {0} has no command: {1!r}".format(i, extra)))
+        entry['index'] = i
+        entry['name'] = entry.get('name') or entry['command']
+        after = entry.get('after') or []
+        entry['requires'] = set([after] if isinstance(after, basestring) else after)
+        entries.append(entry)
+
+    for entry in entries:
+        names.setdefault(entry['name'], entry['index'])
+    for entry in entries:
+        unknown = [n for n in entry['requires'] if n not in names]
+        if unknown:
+            abort(red("Extra {0} comes after the unknown extra(s) {1}".format(entry['name'], ', '.join(unknown))))
+        entry['requires'] = set(names[n] for n in entry['requires']) | barrier
+        if isinstance(extras[entry['index']], dict):
+            continue
+        entry['requires'] |= set(e['index'] for e in entries[:entry['index']])
+        barrier = set([entry['index']])
+
+    waves, done = [], set()
+    while len(done) < len(entries):
+        wave = [e for e in entries if e['index'] not in done and e['requires'] <= done]
+        if not wave:
+            abort(red("EXTRA_COMMANDS depend on each other in a cycle: {0}".format(
+                ', '.join(e['name'] for e in entries if e['index'] not in done))))
+        waves.append(wave)
+        done.update(e['index'] for e in wave)
+    return waves
+
+def run_extras_concurrently(waves):
+    """
+    Runs the waves of extras (see plan_extras) in one remote shell, the
+    extras of a wave EXTRA_CONCURRENCY at a time, each for at most its
+    timeout. Their output is replayed in order, and a failing extra aborts
+    once its wave is done.
+    """
+    concurrency = max(int(getattr(env.deploy_settings, 'EXTRA_CONCURRENCY', 4) or 1), 1)
+    script = ['tmp=$(mktemp -d); trap \'rm -rf $tmp\' EXIT']
+    for wave in waves:
+        for extra in wave:
+            command = extra['command']
+            if extra.get('timeout'):
+                command = 'timeout -k 10 {0} bash -c {1}'.format(int(extra['timeout']), pipes.quote(command))
+            script.append('while [ $(jobs -pr | wc -l) -ge {0} ]; do wait -n 2>/dev/null || sleep 0.2; done'.format(
+                concurrency))
+            script.append('( (\n{0}\n) > $tmp/{1} 2>&1 < /dev/null; echo $? > $tmp/{1}.rc ) &'.format(
+                command, extra['index']))
+        script.append('wait; failed=0')
+        for extra in wave:
+            script.append('echo "@@extra {0} $(cat $tmp/{0}.rc)"; cat $tmp/{0}; [ "$(cat $tmp/{0}.rc)" = 0 ] || failed=1'.format(
+                extra['index']))
+        script.append('[ $failed = 0 ] || exit 1')
+
+    say(cyan('Extras: {0}'.format(' | '.join(', '.join(e['name'] for e in wave) for wave in waves))))
+    out = remote('\n'.join(script), capture=True, warn_only=True, quiet=True)
+
+    extras = dict((e['index'], e) for wave in waves for e in wave)
+    failures, current = [], None
+    for line in out.splitlines():
+        if line.startswith('@@extra '):
+            fields = line.split()
+            current = extras[int(fields[1])]
+            rc = int(fields[2]) if len(fields) > 2 and fields[2].isdigit() else None
+            say(cyan('Extra:  ' + current['command']))
+            if rc == 124 and current.get('timeout'):
+                failures.append('{0} (timed out after {1}s)'.format(current['name'], current['timeout']))
+            elif rc != 0:
+                failures.append('{0} (exit code {1})'.format(current['name'], rc))
+        elif current is not None and output.stdout:
+            say("[{0}] out: {1}".format(env.host_string, line))
+
+    if failures or out.failed:
+        abort(red("Extras failed: {0}".format(', '.join(failures) or out)))
 
 @task
+@timed
 def restart_nginx(*args, **kwargs):
     """
     Restart the nginx service on HOST
+    With ROLLING_RESTART=True nginx is gracefully reloaded instead, after
+    checking its configuration.
 
     runs:
     sudo service nginx restart
     """
 
-    print cyan("Restarting Nginx")
+    if bool_opt('rolling_restart', kwargs, default=False):
+        say(cyan("Reloading Nginx"))
+        if env.deploy_settings.OS_SERVICE_MANAGER == 'upstart':
+            remote('nginx -t && service nginx reload', use_sudo=True)
+        elif env.deploy_settings.OS_SERVICE_MANAGER == 'systemd':
+            remote('nginx -t && systemctl reload nginx', use_sudo=True)
+        else:
+            raise ValueError('invalid OS_SERVICE_MANAGER setting: {}'.format(env.deploy_settings.OS_SERVICE_MANAGER))
+        return None
+
+    say(cyan("Restarting Nginx"))
     
     if env.deploy_settings.OS_SERVICE_MANAGER == 'upstart':
-        sudo('service nginx restart')
+        remote('service nginx restart', use_sudo=True)
     elif env.deploy_settings.OS_SERVICE_MANAGER == 'systemd':
-        sudo('systemctl restart nginx')
+        remote('systemctl restart nginx', use_sudo=True)
     else:
         raise ValueError('invalid OS_SERVICE_MANAGER setting: {}'.format(env.deploy_settings.OS_SERVICE_MANAGER))
 
+SERVICE_PROPERTIES = ['Id', 'LoadState', 'ActiveState', 'SubState', 'MainPID',
+                      'CanReload', 'ActiveEnterTimestamp']
+
+def probe_services(services):
+    """
+    Queries the status of all the services with one sudo round-trip.
+
+    Returns {service: status} where status is a dict of
+        glyph: '+' running, '-' stopped/waiting, '?' unknown, None not found
+        pid: the main process id or None
+        summary: a one line description of the state
+    and, for systemd, the raw SERVICE_PROPERTIES.
+    """
+    manager = env.deploy_settings.OS_SERVICE_MANAGER
+    statuses = {}
+    if manager == 'systemd':
+        out = remote('systemctl show -p {0} {1}'.format(','.join(SERVICE_PROPERTIES), ' '.join(services)),
+                     use_sudo=True, capture=True, quiet=True)
+        # One block of NAME=value lines per unit, in the order asked for
+        blocks, props = [], {}
+        for line in out.splitlines() + ['']:
+            line = line.strip()
+            if not line:
+                if props:
+                    blocks.append(props)
+                props = {}
+            elif '=' in line:
+                k, v = line.split('=', 1)
+                if k in SERVICE_PROPERTIES:
+                    props[k] = v
+        for service, props in zip(services, blocks):
+            active = props.get('ActiveState')
+            if props.get('LoadState') == 'not-found':
+                glyph = None
+            elif active == 'active' and props.get('SubState') == 'running':
+                glyph = '+'
+            elif active in ('inactive', 'failed'):
+                glyph = '-'
+            else:
+                glyph = '?'
+            status = dict(props)
+            status.update({
+                'glyph': glyph,
+                'pid': int(props['MainPID']) if props.get('MainPID', '0') not in ('', '0') else None,
+                'summary': '{0} ({1})'.format(active, props.get('SubState')),
+            })
+            statuses[service] = status
+    elif manager == 'upstart':
+        out = remote('for s in {0}; do echo "@@service $s"; service $s status 2>&1; done'.format(' '.join(services)),
+                     use_sudo=True, capture=True, quiet=True)
+        texts, current = {}, None
+        for line in out.splitlines():
+            if line.startswith('@@service '):
+                current = line.split()[1]
+                texts[current] = []
+            elif current:
+                texts[current].append(line.strip())
+        for service in services:
+            text = ' '.join(texts.get(service, []))
+            if re.search(r'unrecognized service', text):
+                glyph = None
+            elif re.search(r'{} stop/waiting'.format(service), text):
+                glyph = '-'
+            elif re.search(r'{} start/running'.format(service), text):
+                glyph = '+'
+            else:
+                glyph = '?'
+            pid = re.search(r'process (\d+)', text)
+            statuses[service] = {'glyph': glyph, 'pid': int(pid.group(1)) if pid else None,
+                                 'summary': text}
+    else:
+        raise ValueError('invalid OS_SERVICE_MANAGER setting: {}'.format(manager))
+
+    for service in services:
+        statuses.setdefault(service, {'glyph': '?', 'pid': None, 'summary': 'no status'})
+    return statuses
+
+def readiness_check(check):
+    """
+    The shell test for a READINESS_CHECKS entry:
+    http(s)://... must answer with a success status, tcp://host:port must
+    accept a connection, anything else is taken as a shell command.
+    """
+    if check.startswith('http://') or check.startswith('https://'):
+        return 'curl -fsS -o /dev/null --max-time 5 {0}'.format(pipes.quote(check))
+    if check.startswith('tcp://'):
+        host, port = check[len('tcp://'):].rsplit(':', 1)
+        return '(exec 3<>/dev/tcp/{0}/{1}) 2>/dev/null'.format(host, port)
+    return check
+
+def wait_until_ready(services):
+    """
+    Waits, up to READINESS_TIMEOUT seconds, until the services report active
+    and their READINESS_CHECKS pass. One round-trip, aborts on timeout.
+    """
+    manager = env.deploy_settings.OS_SERVICE_MANAGER
+    timeout = int(getattr(env.deploy_settings, 'READINESS_TIMEOUT', 60) or 60)
+    configured = getattr(env.deploy_settings, 'READINESS_CHECKS', None) or {}
+
+    if manager == 'systemd':
+        checks = ['systemctl is-active --quiet {0}'.format(s) for s in services]
+    else:
+        checks = ['status {0} 2>/dev/null | grep -q start/running'.format(s) for s in services]
+    checks += [readiness_check(configured[s]) for s in services if configured.get(s)]
+
+    say(cyan("Waiting for {0} to be ready".format(', '.join(services))))
+    remote('deadline=$(( $(date +%s) + {0} )); until {1}; do '
+           'if [ $(date +%s) -ge $deadline ]; then echo "Not ready after {0}s"; exit 1; fi; '
+           'sleep 1; done'.format(timeout, ' && '.join(checks)), use_sudo=True)
+
+def warm_up_command(entry, timeout, requests):
+    """
+    The shell for a WARMUP entry: an http(s)://... URL is fetched once it
+    answers (waiting up to timeout seconds) and then requests - 1 more times
+    at once, to reach more than one worker. Anything else is run as a shell
+    command (ie. a management command).
+    """
+    if not (entry.startswith('http://') or entry.startswith('https://')):
+        return entry
+    url = pipes.quote(entry)
+    return ('deadline=$(( $(date +%s) + {0} )); until curl -fsS -o /dev/null --max-time 30 {1}; do '
+            'if [ $(date +%s) -ge $deadline ]; then echo "No answer from {1} after {0}s"; break; fi; sleep 1; done; '
+            'for i in $(seq 2 {2}); do curl -s -o /dev/null --max-time 30 {1} & done; wait'.format(
+                timeout, url, requests))
+
+def warm_up(services):
+    """
+    Sends the restarted services their WARMUP URLs and commands, so their
+    workers have imported and cached what they need before the next batch
+    (or host) goes. One round-trip, a failing warm-up only warns.
+    """
+    configured = getattr(env.deploy_settings, 'WARMUP', None) or {}
+    entries = []
+    for service in services:
+        warmups = configured.get(service) or []
+        entries += [warmups] if isinstance(warmups, basestring) else list(warmups)
+    if not entries:
+        return
+
+    timeout = int(getattr(env.deploy_settings, 'READINESS_TIMEOUT', 60) or 60)
+    requests = max(int(getattr(env.deploy_settings, 'WARMUP_REQUESTS', 4) or 1), 1)
+    say(cyan("Warming up {0}".format(', '.join(services))))
+    with cd(project_path()):
+        with prefix('source activate'):
+            remote('\n'.join(warm_up_command(e, timeout, requests) for e in entries), warn_only=True)
+
+def restart_services(services, statuses=None):
+    """
+    Restarts the services BOUNCE_BATCH_SIZE at a time, the services of a batch
+    concurrently and with one sudo round-trip.
+
+    With ROLLING_RESTART=True units that can reload are reloaded instead and
+    each batch must be ready (see wait_until_ready) before the next one goes.
+    Each batch is warmed up (see warm_up) before the next one goes.
+    """
+    manager = env.deploy_settings.OS_SERVICE_MANAGER
+    size = max(int(getattr(env.deploy_settings, 'BOUNCE_BATCH_SIZE', 1) or 1), 1)
+    rolling = bool_opt('rolling_restart', {}, default=False)
+    statuses = statuses or {}
+    for i in range(0, len(services), size):
+        batch = services[i:i + size]
+        if rolling and manager == 'systemd':
+            reloadable = [s for s in batch if statuses.get(s, {}).get('CanReload') == 'yes']
+            if reloadable:
+                remote('systemctl reload-or-restart {}'.format(' '.join(reloadable)), use_sudo=True)
+            batch_restart = [s for s in batch if s not in reloadable]
+            if batch_restart:
+                remote('systemctl restart {}'.format(' '.join(batch_restart)), use_sudo=True)
+        elif manager == 'upstart':
+            if len(batch) == 1:
+                remote('service %s restart' % batch[0], use_sudo=True)
+            else:
+                remote('pids=""; for s in {0}; do service $s restart & pids="$pids $!"; done; '
+                       'rc=0; for p in $pids; do wait $p || rc=$?; done; exit $rc'.format(' '.join(batch)),
+                       use_sudo=True)
+        elif manager == 'systemd':
+            # systemctl runs the restart jobs of all the units given concurrently
+            remote('systemctl restart {}'.format(' '.join(batch)), use_sudo=True)
+        else:
+            raise ValueError('invalid OS_SERVICE_MANAGER setting: {}'.format(manager))
+
+        if rolling:
+            wait_until_ready(batch)
+        warm_up(batch)
+
 @task
+@fleet
+@timed
+@skip_if_deployed
 def bounce_services(*args, **kwargs):
     """
     Restarts the services on HOST from the BOUNCE_SERVICES list of the settings.
 
+    The statuses of all the services are probed at once, the restarts happen
+    BOUNCE_BATCH_SIZE services at a time.
+
     runs:
+    sudo systemctl show -p ... X Y Z (or service X status for each of them)
     sudo service X restart (where X is each member of the BOUNCE_SERVICES list)
 
     :restart_nginx=True will also restart nginx
@@ -478,93 +2762,149 @@ def bounce_services(*args, **kwargs):
     }
 
     BSOIR = env.deploy_settings.BOUNCE_SERVICES_ONLY_IF_RUNNING
-    print cyan("Bouncing processes...{0}").format("(BOUNCING_SERVICES_ONLY_IF_RUNNING)" if BSOIR else "")
+    say(cyan("Bouncing processes...{0}").format("(BOUNCING_SERVICES_ONLY_IF_RUNNING)" if BSOIR else ""))
     the_services = env.deploy_settings.BOUNCE_SERVICES
-    print cyan(the_services)
-    
-    there = []
-    not_there = []
-    for service in env.deploy_settings.BOUNCE_SERVICES:
-        if env.deploy_settings.OS_SERVICE_MANAGER == 'upstart':
-            status = sudo('service %s status' % service, quiet=True)
-            
-            if re.search(r'unrecognized service', status):
-                not_there.append(service)
-                continue
-            
-            if re.search(r'{} stop/waiting'.format(service), status):
-                sglyph = '-'
-            elif re.search(r'{} start/running'.format(service), status):
-                sglyph = '+'
-            else:
-                sglyph = '?'
-        elif env.deploy_settings.OS_SERVICE_MANAGER == 'systemd':
-            status = sudo('systemctl status --full --no-pager %s' % service, quiet=True)
-            
-            if 'Loaded: not-found' in status:
-                not_there.append(service)
-            else:
-                if 'Active: inactive' in status:
-                    sglyph = '-'
-                elif 'Active: active (running)' in status:
-                    sglyph = '+'
-                else:
-                    sglyph = '?'
-        else:
-            raise ValueError('invalid OS_SERVICE_MANAGER setting: {}'.format(env.deploy_settings.OS_SERVICE_MANAGER))
-        
-        there.append((sglyph, service))
+    say(cyan(the_services))
+
+    statuses = probe_services(the_services)
+    not_there = [s for s in the_services if statuses[s]['glyph'] is None]
 
-    for status, service in there:
-        print green("{0}: {1}".format(service, STATUS[status]))
+    bouncing = []
+    for service in the_services:
+        status = statuses[service]['glyph']
+        if status is None:
+            continue
+        say(green("{0}: {1}".format(service, STATUS[status])))
         if status != '+' and BSOIR:
-            print red("{} NOT bouncing".format(service))
+            say(red("{} NOT bouncing".format(service)))
             continue
-        
-        if env.deploy_settings.OS_SERVICE_MANAGER == 'upstart':
-            sudo('service %s restart' % service)
-        elif env.deploy_settings.OS_SERVICE_MANAGER == 'systemd':
-            sudo('systemctl restart {}'.format(service))
-        else:
-            pass ###intentional - already checked
+        bouncing.append(service)
+
+    restart_services(bouncing, statuses)
 
     for s in not_there:
-        print magenta("{0} not found on {1}".format(s, env.deploy_settings.HOST))
+        say(magenta("{0} not found on {1}".format(s, env.host_string)))
 
     if bool_opt('restart_nginx', kwargs, default=False):
         restart_nginx()
 
 
 @task
+@fleet
+@timed
 def services_status(*args, **kwargs):
     """
     Returns a list of the current status of the services on HOST from the BOUNCE_SERVICES list.
 
     runs:
-    sudo service X status (where x is each member of the BOUNCE_SERVICES list)
+    sudo systemctl show -p ... X Y Z (or service X status for each of them)
     """
 
+    statuses = probe_services(env.deploy_settings.BOUNCE_SERVICES)
     for service in env.deploy_settings.BOUNCE_SERVICES:
-        if env.deploy_settings.OS_SERVICE_MANAGER == 'upstart':
-            status = sudo('service %s status' % service, quiet=True)
-            hilight = green
-            
-            if re.search(r'{} stop/waiting'.format(service), status):
-                hilight = red
-            
-            print hilight(status)
-        elif env.deploy_settings.OS_SERVICE_MANAGER == 'systemd':
-            status = sudo('systemctl status --full --no-pager {}'.format(service), quiet=True)
-            hilight = green
-            
-            if 'Active: inactive' in status or 'Active: failed' in status:
-                hilight = red
-            
-            print hilight(status)
-        else:
-            raise ValueError('invalid OS_SERVICE_MANAGER setting: {}'.format(env.deploy_settings.OS_SERVICE_MANAGER))
+        status = statuses[service]
+        hilight = {'+': green, None: magenta}.get(status['glyph'], red)
+        print hilight("[{0}] {1}: {2}{3}".format(env.host_string, service, status['summary'],
+                                                 ' pid {0}'.format(status['pid']) if status['pid'] else ''))
+    return statuses
+
+def host_status(*args, **kwargs):
+    """
+    The status of the current host as a JSON-able dict: the deployed commit and
+    manifest, and the state, pid and uptime (in seconds) of each of the
+    BOUNCE_SERVICES. A host that can't be reached comes back with state
+    'unreachable' rather than failing the run.
+    """
+    services = env.deploy_settings.BOUNCE_SERVICES
+    try:
+        head, requirements, manifest = deploy_manifest()
+        statuses = probe_services(services)
+        pids = [s['pid'] for s in statuses.values() if s['pid']]
+        uptimes = {}
+        if pids:
+            out = remote('ps -o pid=,etimes= -p {0}'.format(','.join(str(p) for p in pids)),
+                         capture=True, quiet=True)
+            for line in out.splitlines():
+                fields = line.split()
+                if len(fields) == 2 and fields[0].isdigit() and fields[1].isdigit():
+                    uptimes[int(fields[0])] = int(fields[1])
+    except (SystemExit, Exception) as e:
+        return {'state': 'unreachable', 'error': getattr(e, 'message', '') or repr(e)}
+
+    states = {'+': 'running', '-': 'stopped', None: 'not-found'}
+    return {
+        'state': 'ok' if all(s['glyph'] == '+' for s in statuses.values()) else 'degraded',
+        'commit': head,
+        'requirements': requirements,
+        'manifest': manifest,
+        'services': dict((service, {'state': states.get(status['glyph'], 'unknown'),
+                                    'pid': status['pid'],
+                                    'uptime': uptimes.get(status['pid']),
+                                    'summary': status['summary']})
+                         for service, status in statuses.items()),
+    }
+
+def status_cache_file(hosts):
+    """
+    The STATUS_CACHE file for a snapshot of these hosts, DEPLOY_PATH and the
+    BOUNCE_SERVICES, which may well be shared with other projects
+    """
+    ds = env.deploy_settings
+    key = json.dumps([hosts, ds.DEPLOY_PATH, ds.BOUNCE_SERVICES])
+    return os.path.join(local_cache('STATUS_CACHE', '~/.cache/surge/status'),
+                        hashlib.sha1(key).hexdigest() + '.json')
+
+@task
+@targeted
+def fleet_status(*args, **kwargs):
+    """
+    Prints the status of every host and service of the deploy target as JSON,
+    probing the hosts in parallel.
+
+    Snapshots are cached locally in STATUS_CACHE for STATUS_TTL seconds so
+    repeated polls don't go back to the hosts.
+
+    :refresh=True ignores the cached snapshot
+    :output=path writes the JSON to path instead of printing it
+    """
+    hosts = target_hosts()
+    ttl = float(getattr(env.deploy_settings, 'STATUS_TTL', 0) or 0)
+    cache_file = status_cache_file(hosts)
+
+    snapshot = None
+    if ttl > 0 and not bool_opt('refresh', kwargs):
+        try:
+            with open(cache_file) as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError):
+            pass
+        if snapshot and time.time() - snapshot.get('probed_at', 0) > ttl:
+            snapshot = None
+
+    if snapshot is None:
+        with hide('everything', 'status'):
+            results = on_hosts(host_status)
+        snapshot = {'probed_at': time.time(),
+                    'hosts': dict((host, results[host]['result']) for host in hosts)}
+        if ttl > 0:
+            if not os.path.isdir(os.path.dirname(cache_file)):
+                os.makedirs(os.path.dirname(cache_file))
+            # Written aside and renamed so concurrent polls never read half a file
+            with open(cache_file + '.tmp.{0}'.format(os.getpid()), 'w') as f:
+                json.dump(snapshot, f)
+            os.rename(f.name, cache_file)
+    snapshot['age'] = round(time.time() - snapshot['probed_at'], 1)
+
+    text = json.dumps(snapshot, indent=2, sort_keys=True)
+    if kwargs.get('output'):
+        with open(kwargs['output'], 'w') as f:
+            f.write(text + '\n')
+    else:
+        print text
+    return snapshot
 
 @task
+@timed
 def update_crontab(*args, **kwargs):
     """
     Replaces the current crontab for CRONTAB_OWNER on HOST with CRON_FILE
@@ -575,26 +2915,512 @@ def update_crontab(*args, **kwargs):
 
     if getattr(env.deploy_settings, 'CRON_FILE', None) and \
        getattr(env.deploy_settings, 'CRONTAB_OWNER', None):
-        print green("Updating crontab...")
-        sudo('crontab -u %s %s' % (env.deploy_settings.CRONTAB_OWNER,
-                                   env.deploy_settings.CRON_FILE))
-        print ""
+        say(green("Updating crontab..."))
+        command = 'crontab -u %s %s' % (env.deploy_settings.CRONTAB_OWNER, env.deploy_settings.CRON_FILE)
+        # During a deploy only when CRON_FILE changed since the last one
+        recorded = (env.get('surge_manifest') or {}).get('crontab')
+        if recorded:
+            command = 'if [ "$(sha1sum < {0} | cut -c1-40)" != {1} ]; then {2}; else echo "Crontab unchanged"; fi'.format(
+                env.deploy_settings.CRON_FILE, recorded, command)
+        remote(command, use_sudo=True)
+        say("")
 
 @task
+@timed
+@skip_if_deployed
 @needs_django
 @skip_if_not('SKIP_SYNCDB', False)
 def sync_db(*args, **kwargs):
     """
     Runs the Django manaagement command syncdb for DJANGO_PROJECT=True
 
+    Skipped when no file matching MIGRATION_INPUT_PATTERNS changed since the
+    last syncdb.
+
     runs:
     manage sync_db
+
+    :force_migrate=True will syncdb regardless
     """
 
-    print cyan("Sync DB")
-    with cd(env.deploy_settings.DEPLOY_PATH):
+    head, changed = changes_since('syncdb.commit')
+    if changed is not None and not bool_opt('force_migrate', kwargs, default=False):
+        if not [f for f in changed if matches_setting(f, 'MIGRATION_INPUT_PATTERNS')]:
+            say(green("No model changes, skipping syncdb"))
+            record_commit('syncdb.commit', head)
+            return None
+
+    say(cyan("Sync DB"))
+    with cd(project_path()):
         with prefix('source activate'):
-            run("./manage.py syncdb")
+            remote("./manage.py syncdb")
+
+    record_commit('syncdb.commit', head)
+
+class Step(object):
+    """
+    A step of full_deploy, f is run (without arguments) on every host once the
+    steps it comes after have, and when when() (if given) says so.
+
+    Consecutive steps of the same batch share a batched() remote script.
+    """
+    def __init__(self, name, f, phase='prepare', after=(), before=(), when=None, batch=None):
+        self.name = name
+        self.f = f
+        self.phase = phase
+        self.after = list(after)
+        self.before = list(before)
+        self.when = when
+        self.batch = batch
+
+    def __repr__(self):
+        return '<Step {0}>'.format(self.name)
+
+DEPLOY_STEPS = []
+
+def add_step(name, f, phase='prepare', after=(), before=(), when=None, batch=None):
+    """
+    Adds (or replaces) the named step of full_deploy, see Step.
+
+    phase is 'prepare' (everything up to activating a new deploy) or
+    'activate' (putting it into service, see ROLLING_RESTART).
+    """
+    DEPLOY_STEPS[:] = [s for s in DEPLOY_STEPS if s.name != name]
+    DEPLOY_STEPS.append(Step(name, f, phase, after, before, when, batch))
+
+def deploy_step(name=None, phase='prepare', after=(), before=(), when=None, batch=None):
+    """
+    A decorator adding the function as a step of full_deploy, see add_step
+    """
+    def add(f):
+        add_step(name or f.__name__, f, phase, after, before, when, batch)
+        return f
+    return add
+
+def remove_step(name):
+    DEPLOY_STEPS[:] = [s for s in DEPLOY_STEPS if s.name != name]
+
+def setting_is(setting, what=True):
+    """
+    A when for a step, to only run it when the setting is what (True or False)
+    """
+    return lambda: bool_opt(setting, {}) == what
+
+def plan_steps(phase):
+    """
+    Orders the steps of the phase into waves, each of steps only depending on
+    steps of earlier waves (or of an earlier phase).
+    """
+    known = set(s.name for s in DEPLOY_STEPS)
+    steps = [s for s in DEPLOY_STEPS if s.phase == phase]
+    names = set(s.name for s in steps)
+
+    requires = dict((s.name, set()) for s in steps)
+    for step in steps:
+        for other in step.after + step.before:
+            if other not in known:
+                abort(red("Step {0} refers to the unknown step {1}".format(step.name, other)))
+        requires[step.name].update(n for n in step.after if n in names)
+        for n in step.before:
+            if n in names:
+                requires[n].add(step.name)
+
+    waves, done = [], set()
+    while len(done) < len(steps):
+        wave = [s for s in steps if s.name not in done and requires[s.name] <= done]
+        if not wave:
+            abort(red("The {0} steps depend on each other in a cycle: {1}".format(
+                phase, ', '.join(s.name for s in steps if s.name not in done))))
+        waves.append(wave)
+        done.update(s.name for s in wave)
+    return waves
+
+def run_steps(phase):
+    """
+    Runs the steps of the phase on the host a wave at a time, in the
+    dependency order of plan_steps rather than the order they were added.
+    With STEP_CONCURRENCY above 1 the independent steps of a wave run at the
+    same time, that many at most, otherwise one after another.
+    """
+    concurrency = int(getattr(env.deploy_settings, 'STEP_CONCURRENCY', 1) or 1)
+    waves = plan_steps(phase)
+    if concurrency > 1:
+        groups = [wave[i:i + concurrency] for wave in waves for i in range(0, len(wave), concurrency)]
+    else:
+        groups = [[step] for wave in waves for step in wave]
+
+    i = 0
+    while i < len(groups):
+        if len(groups[i]) > 1:
+            run_concurrently(groups[i])
+            i += 1
+            continue
+
+        # The following single steps of the same batch go in one
+        run = [groups[i][0]]
+        while i + len(run) < len(groups) and len(groups[i + len(run)]) == 1 and \
+                run[0].batch and groups[i + len(run)][0].batch == run[0].batch:
+            run.append(groups[i + len(run)][0])
+        i += len(run)
+        if run[0].batch:
+            with batched(run[0].batch):
+                for step in run:
+                    run_step(step)
+        else:
+            run_step(run[0])
+
+def run_step(step):
+    if step.when is None or step.when():
+        step.f()
+
+def run_concurrently(steps):
+    """
+    Runs the steps at the same time, each in a process with a connection to
+    the host of its own (or sharing the ssh master, SSH_MULTIPLEX). What they
+    set in env (surge_* like surge_release) is handed back, and any failing
+    aborts once they all finished.
+    """
+    print cyan("Running {0} at the same time".format(', '.join(s.name for s in steps)))
+    if bool_opt('ssh_multiplex', {}) and not ssh_connected():
+        # Rather than each step racing to become the master
+        with tracing('connection', 'opened'):
+            ssh_connect()
+    queue = multiprocessing.Queue()
+
+    def step_run(step):
+        connections.clear()
+        before = dict((k, v) for k, v in env.items() if k.startswith('surge_'))
+        status, error = 'ok', None
+        with settings(surge_trace=[]):
+            try:
+                with batched(step.name):
+                    run_step(step)
+            except (SystemExit, Exception) as e:
+                status, error = 'failed', getattr(e, 'message', '') or repr(e)
+            trace = env.surge_trace
+        changed = dict((k, v) for k, v in env.items() if k.startswith('surge_') and
+                       k not in ('surge_trace', 'surge_batch') and before.get(k) != v)
+        queue.put((step.name, status, error, changed, trace))
+
+    processes = [multiprocessing.Process(target=step_run, args=(step,)) for step in steps]
+    for process in processes:
+        process.start()
+    # Read before joining, a child can not exit before its result is read
+    results = [queue.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    failures = []
+    for name, status, error, changed, trace in results:
+        env.update(changed)
+        if env.get('surge_trace') is not None:
+            env.surge_trace.extend(trace)
+        if status != 'ok':
+            failures.append('{0} ({1})'.format(name, error))
+    if failures:
+        abort(red("Failed steps: {0}".format(', '.join(failures))))
+
+## The steps of full_deploy, run in the dependency order of plan_steps (see run_steps)
+# With ARTIFACT the hosts get what build_artifact built instead
+add_step('is_remote_clean', is_remote_clean, when=setting_is('ARTIFACT', False))
+add_step('fix_ownerships_before_pull', fix_ownerships, when=setting_is('RELEASES', False), batch='update')
+add_step('pull', pull, after=['is_remote_clean', 'fix_ownerships_before_pull'], when=setting_is('ARTIFACT', False),
+         batch='update')
+# With RELEASES the rest happens in the new release
+add_step('build_release', build_release, after=['pull'], when=setting_is('ARTIFACT', False), batch='update')
+add_step('receive_artifact', receive_artifact, after=['build_release'], when=setting_is('ARTIFACT'), batch='update')
+add_step('check_deployed', check_deployed, after=['build_release', 'receive_artifact'], batch='update')
+add_step('update_submodules', update_submodules, after=['check_deployed'], when=setting_is('ARTIFACT', False),
+         batch='update')
+add_step('fix_logfile_permissions', fix_logfile_permissions, after=['check_deployed'], batch='update')
+add_step('install_requirements', install_requirements, after=['update_submodules'],
+         when=setting_is('ARTIFACT', False), batch='update')
+add_step('collectstatic', collectstatic, after=['install_requirements'], when=setting_is('ARTIFACT', False),
+         batch='django')
+add_step('sync_db', sync_db, after=['install_requirements'], when=setting_is('ARTIFACT', False), batch='django')
+add_step('run_migrations', run_migrations, after=['sync_db'], when=setting_is('ARTIFACT', False), batch='django')
+add_step('run_extras', run_extras, after=['collectstatic', 'run_migrations'], batch='finish')
+# post fix owners after checkout and other actions
+add_step('precompile', precompile, after=['run_extras'], when=setting_is('PRECOMPILE'), batch='finish')
+add_step('fix_ownerships', fix_ownerships, after=['run_extras', 'fix_logfile_permissions', 'precompile'],
+         batch='finish')
+
+# A rolling activation runs apart from the prepare phase
+add_step('recheck_deployed', check_deployed, phase='activate',
+         when=lambda: env.get('surge_unchanged') is None, batch='activate')
+add_step('switch_release', switch_release, phase='activate', after=['recheck_deployed'], batch='activate')
+add_step('bounce_services', bounce_services, phase='activate', after=['switch_release'], batch='activate')
+add_step('update_crontab', update_crontab, phase='activate', after=['switch_release'], batch='activate')
+add_step('write_manifest', write_manifest, phase='activate', after=['bounce_services', 'update_crontab'],
+         batch='activate')
+add_step('prune_releases', prune_releases, phase='activate', after=['write_manifest'], batch='activate')
+
+
+LOCK_SCRIPT = """
+lock={lock}; queue={lock}.queue; ticket={ticket}
+mkdir -p $(dirname $lock)
+if [ -n "$ticket" ]; then
+    mkdir -p $queue && touch $queue/$ticket
+    find $queue -type f -mmin +{stale_minutes} -delete
+    for t in $queue/*; do
+        if [ "${{t##*/}}" \\> "$ticket" ]; then rm -f $queue/$ticket; echo "@@lock superseded"; exit 0; fi
+    done
+fi
+if mkdir $lock 2>/dev/null; then
+    echo {owner} > $lock/owner; [ -n "$ticket" ] && rm -f $queue/$ticket; echo "@@lock acquired"; exit 0
+fi
+age=$(( $(date +%s) - $(stat -c %Y $lock 2>/dev/null || date +%s) ))
+owner=$(cat $lock/owner 2>/dev/null)
+if [ $age -ge {stale} ] && mv $lock $lock.stale.$$ 2>/dev/null; then
+    rm -rf $lock.stale.$$; echo "@@lock stale $age $owner"; exit 0
+fi
+echo "@@lock busy $age $owner"
+"""
+
+def lock_path():
+    """
+    The deploy lock directory, SURGE_STATE_DIR/lock of DEPLOY_PATH, or with
+    RELEASES=True DEPLOY_PATH/.surge-lock. Waiting deploys queue up in the
+    .queue directory next to it.
+    """
+    ds = env.deploy_settings
+    if bool_opt('releases', {}):
+        return '{0}/.surge-lock'.format(ds.DEPLOY_PATH)
+    return '{0}/{1}/lock'.format(ds.DEPLOY_PATH, ds.SURGE_STATE_DIR)
+
+def lock_holder_gone(owner):
+    """
+    Whether the owner of a lock is a deploy of this machine that is no longer running
+    """
+    parts = owner.split()
+    if len(parts) < 2 or parts[0].rsplit('@', 1)[-1] != socket.gethostname() or not parts[1].isdigit():
+        return False
+    try:
+        os.kill(int(parts[1]), 0)
+    except OSError as e:
+        return e.errno == 3  # ESRCH
+    return False
+
+@contextmanager
+def deploy_lock(*args, **kwargs):
+    """
+    With DEPLOY_LOCK=True, holds the lock of the deploy target (see
+    lock_path) on its first host (or the fab -H host) for the wrapped block. Waits up
+    to LOCK_TIMEOUT seconds for it. A lock older than LOCK_STALE seconds, or
+    held by a deploy of this machine that is gone, is broken.
+
+    With DEPLOY_QUEUE=True as well a waiting deploy leaves (yields False) as
+    soon as a later deploy waits too, only the latest one goes and deploys
+    the newest commit of the branch.
+    """
+    if not bool_opt('deploy_lock', kwargs):
+        yield True
+        return
+
+    ds = env.deploy_settings
+    lock = lock_path()
+    ticket = '{0:.6f}.{1}'.format(time.time(), os.getpid()) if bool_opt('deploy_queue', kwargs) else ''
+    owner = '{0}@{1} {2} {3}'.format(env.local_user, socket.gethostname(), os.getpid(), time.strftime('%Y-%m-%dT%H:%M:%S'))
+    stale = int(getattr(ds, 'LOCK_STALE', 3600) or 3600)
+    timeout = int(getattr(ds, 'LOCK_TIMEOUT', 1800) or 0)
+    script = LOCK_SCRIPT.format(lock=lock, ticket=ticket,
+                                owner=pipes.quote(owner), stale=stale, stale_minutes=max(stale / 60, 1))
+
+    host = env.host_string if env.hosts else target_hosts()[0]
+    with settings(host_string=host):
+        started = time.time()
+        waiting = False
+        while True:
+            out = remote(script, capture=True, quiet=True)
+            state = ([line.split(None, 3)[1:] for line in out.splitlines() if line.startswith('@@lock ')] or [['']])[-1]
+            if state[0] == 'acquired':
+                break
+            if state[0] == 'superseded':
+                print green("A later deploy is waiting for the lock, leaving the newest commit to it")
+                yield False
+                return
+            holder = state[2] if len(state) > 2 else 'unknown'
+            if state[0] == 'stale':
+                print yellow("Broke the stale deploy lock of {0} ({1}s old)".format(holder, state[1]))
+                continue
+            if state[0] == 'busy' and lock_holder_gone(holder):
+                print yellow("Breaking the deploy lock of {0}, it is no longer running".format(holder))
+                remote('[ "$(cat {0}/owner 2>/dev/null)" = {1} ] && rm -rf {0}; true'.format(
+                    lock, pipes.quote(holder)), quiet=True)
+                continue
+            if state[0] != 'busy':
+                abort(red("Could not take the deploy lock {0}:\n{1}".format(lock, out)))
+            if time.time() - started >= timeout:
+                if ticket:
+                    remote('rm -f {0}.queue/{1}'.format(lock, ticket), quiet=True)
+                abort(red("{0} is still locked by {1} after {2}s".format(lock, holder, timeout)))
+            if not waiting:
+                print cyan("Waiting for the deploy of {0} to finish{1}".format(
+                    holder, " (DEPLOY_QUEUE)" if ticket else ""))
+                waiting = True
+            time.sleep(5)
+
+    try:
+        yield True
+    finally:
+        with settings(host_string=host):
+            remote('[ "$(cat {0}/owner 2>/dev/null)" = {1} ] && rm -rf {0}; true'.format(lock, pipes.quote(owner)),
+                   quiet=True)
+
+def canary_hosts():
+    """
+    The hosts of the deploy target deployed first with CANARY: that many hosts,
+    or with a '%' that percentage of them (rounded up), always leaving one host
+    as the baseline.
+    """
+    hosts = target_hosts()
+    canary = str(getattr(env.deploy_settings, 'CANARY', 0) or 0).strip()
+    if canary.endswith('%'):
+        count = int(-(-len(hosts) * float(canary[:-1]) // 100))
+    elif canary.lower() in ('true', 'false'):
+        count = strtobool(canary)
+    else:
+        count = int(canary)
+    return hosts[:min(max(count, 0), len(hosts) - 1)]
+
+def http_benchmark(urls, requests=50, concurrency=5, timeout=10):
+    """
+    Requests the urls (round-robin) requests times, concurrency at a time, after
+    one unmeasured request per concurrent client to warm up. Any exception or
+    error status counts as an error.
+
+    Returns {requests, errors, error_rate, p50, p99} with the latencies of the
+    successful requests in seconds (None if there were none).
+    """
+    import threading
+    import urllib2
+
+    urls = [urls] if isinstance(urls, basestring) else list(urls)
+    latencies, errors, lock = [], [0], threading.Lock()
+    queue = range(requests)
+
+    def fetch(url):
+        started = time.time()
+        try:
+            urllib2.urlopen(url, timeout=timeout).read()
+        except Exception:
+            return None
+        return time.time() - started
+
+    def client(n):
+        fetch(urls[n % len(urls)])
+        while True:
+            with lock:
+                if not queue:
+                    return
+                i = queue.pop()
+            latency = fetch(urls[i % len(urls)])
+            with lock:
+                if latency is None:
+                    errors[0] += 1
+                else:
+                    latencies.append(latency)
+
+    clients = [threading.Thread(target=client, args=(n,)) for n in range(max(int(concurrency), 1))]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+
+    latencies.sort()
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+
+    return {'requests': requests, 'errors': errors[0], 'error_rate': errors[0] / float(max(requests, 1)),
+            'p50': percentile(0.5), 'p99': percentile(0.99)}
+
+def canary_urls(host):
+    """
+    The CANARY_URL(s) of a host, {host} in them replaced by its hostname
+    """
+    urls = getattr(env.deploy_settings, 'CANARY_URL', None) or []
+    urls = [urls] if isinstance(urls, basestring) else urls
+    return [url.format(host=normalize(host)[1]) for url in urls]
+
+def canary_regressions(canary, baseline):
+    """
+    How the benchmark of a canary goes beyond the CANARY_MAX_* thresholds of the
+    baseline's, an empty list if it doesn't.
+    """
+    ds = env.deploy_settings
+    regressions = []
+    max_errors = float(getattr(ds, 'CANARY_MAX_ERRORS', 0.01))
+    if canary['error_rate'] > baseline['error_rate'] + max_errors:
+        regressions.append("error rate {0:.1%} vs {1:.1%}".format(canary['error_rate'], baseline['error_rate']))
+    for p in ('p50', 'p99'):
+        limit = float(getattr(ds, 'CANARY_MAX_' + p.upper(), 1.5))
+        if canary[p] is None:
+            regressions.append("no successful requests")
+            break
+        if baseline[p] is not None and canary[p] > baseline[p] * limit:
+            regressions.append("{0} {1:.0f}ms vs {2:.0f}ms".format(p, canary[p] * 1000, baseline[p] * 1000))
+    return regressions
+
+def canary_deploy(canaries, baseline, *args, **kwargs):
+    """
+    Deploys the canaries, then benchmarks them and the baseline host (which
+    still has the previous deploy) at the same time with CANARY_URL. Aborts,
+    after rolling the canaries back with RELEASES=True, if any canary went
+    beyond the CANARY_MAX_* thresholds.
+    """
+    import threading
+
+    ds = env.deploy_settings
+    print blue("Deploying the canary host(s) {0}".format(', '.join(canaries)))
+    with settings(surge_hosts=canaries):
+        deploy_host(*args, **kwargs)
+
+    if not canary_urls(baseline):
+        print yellow("No CANARY_URL to benchmark the canaries with, carrying on")
+        return
+
+    print cyan("Benchmarking {0} against {1}".format(', '.join(canaries), baseline))
+    results = {}
+
+    def benchmark(host):
+        results[host] = http_benchmark(canary_urls(host), int(getattr(ds, 'CANARY_REQUESTS', 50)),
+                                       int(getattr(ds, 'CANARY_CONCURRENCY', 5)),
+                                       int(getattr(ds, 'READINESS_TIMEOUT', 60) or 60))
+
+    threads = [threading.Thread(target=benchmark, args=(host,)) for host in canaries + [baseline]]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    failed = {}
+    for host in [baseline] + canaries:
+        result = results[host]
+        regressions = canary_regressions(result, results[baseline]) if host != baseline else []
+        if regressions:
+            failed[host] = regressions
+        print (red if regressions else green)("{0:<40} {1:>5} errors {2:>8} p50 {3:>8} p99  {4}".format(
+            host + (' (baseline)' if host == baseline else ''), result['errors'],
+            '-' if result['p50'] is None else '{0:.0f}ms'.format(result['p50'] * 1000),
+            '-' if result['p99'] is None else '{0:.0f}ms'.format(result['p99'] * 1000),
+            ', '.join(regressions)))
+
+    if failed:
+        rolled_back = ''
+        if bool_opt('releases', kwargs):
+            print yellow("Rolling the canary host(s) back")
+            try:
+                with settings(surge_hosts=canaries):
+                    rollback(*args, **kwargs)
+                rolled_back = ', rolled back'
+            except SystemExit:
+                rolled_back = ', the rollback failed'
+        abort(red("Canary regression on {0}{1}, not deploying the other hosts".format(
+            ', '.join(sorted(failed)), rolled_back)))
+    print green("Canary within thresholds, deploying the other hosts")
 
 @task(default=True)
 @surge_stack
@@ -614,9 +3440,11 @@ def full_deploy(*args, **kwargs):
         - Changing owner:group to draftboard
         - Bounce the webserver
 
-    runs:
+    runs the DEPLOY_STEPS (see add_step), by default:
+    is_remote_clean
     fix_ownerships
     pull
+    build_release (or with ARTIFACT=True build_artifact once, receive_artifact)
     update_submodules
     fix_logfile_permissions
     install_requirements
@@ -624,9 +3452,15 @@ def full_deploy(*args, **kwargs):
     sync_db
     run_migrations
     run_extras
+    precompile (PRECOMPILE=True)
     fix_ownerships
+    switch_release
     bounce_services
     update_crontab
+    prune_releases
+
+    With CANARY the canary hosts are deployed and benchmarked first (see
+    canary_deploy).
     """
 
 
@@ -637,42 +3471,111 @@ def full_deploy(*args, **kwargs):
 
     is_local_clean()
 
-    is_remote_clean()
+    with deploy_lock(*args, **kwargs) as locked:
+        if not locked:
+            return
+
+        if bool_opt('wheelhouse', kwargs, default=False):
+            # Once, before the hosts go their own way
+            build_wheelhouse()
+
+        if bool_opt('artifact', kwargs, default=False):
+            build_artifact(*args, **kwargs)
+
+        fanout = int(getattr(env.deploy_settings, 'FANOUT', 0) or 0)
+        if fanout and len(target_hosts()) > fanout and not env.hosts:
+            # Spread the release over the hosts before deploying them
+            if bool_opt('artifact', kwargs, default=False):
+                fan_out(receive_artifact)
+            elif bool_opt('wheelhouse', kwargs, default=False) and not bool_opt('releases', kwargs):
+                fan_out(receive_wheelhouse)
+
+        canaries = canary_hosts() if not env.hosts else []
+        rest = [h for h in target_hosts() if h not in canaries]
+        if canaries:
+            canary_deploy(canaries, rest[0], *args, **kwargs)
+
+        with settings(surge_hosts=rest):
+            if bool_opt('rolling_restart', kwargs, default=False) and len(rest) > 1 and not env.hosts:
+                # Get every host ready first, then switch them over a few at a time
+                on_hosts(prepare_host, *args, **kwargs)
+                with settings(surge_wave_size=getattr(env.deploy_settings, 'ROLLING_HOST_BATCH_SIZE', 1)):
+                    on_hosts(activate_host, *args, **kwargs)
+            else:
+                deploy_host(*args, **kwargs)
+
+    print green("Done!")
+
+
+@fleet
+def deploy_host(*args, **kwargs):
+    """
+    The per host part of full_deploy
+    """
+
+    with host_state():
+        prepare_host(*args, **kwargs)
+
+        activate_host(*args, **kwargs)
+
+
+def host_state():
+    """
+    A settings() context for deploying one host, so what the deploy works out
+    about the host (surge_release, surge_unchanged, surge_manifest) goes with it
+    rather than on to the tasks (or targets) run after it.
+    """
+    return settings(surge_release=None, surge_unchanged=None, surge_manifest=None)
+
+
+def prepare_host(*args, **kwargs):
+    """
+    Everything of full_deploy up to bouncing the services, the 'prepare' steps
+    """
 
     print ""
     print green("Starting deployment...")
     print ""
 
-    print green("Updating environment...")
-
-    fix_ownerships()
-
-    pull()
+    run_steps('prepare')
 
-    update_submodules()
 
-    fix_logfile_permissions()
+def activate_host(*args, **kwargs):
+    """
+    Puts what prepare_host got ready into service, the 'activate' steps
 
-    install_requirements()
+    With RELEASES=True they start out in the release prepare_host built, as
+    prepare_host left them, even when that was another process (ROLLING_RESTART).
+    """
 
-    collectstatic()
+    release = env.get('surge_release')
+    if bool_opt('releases', kwargs) and not release:
+        release = release_path(repo_head())
+    with settings(surge_release=release):
+        run_steps('activate')
 
-    sync_db()
 
-    # if not bool_opt('skip_migrate', kwargs, default=False):
-    #     run_migrations()
-    run_migrations()
+@task
+@surge_stack
+def prepare_release(*args, **kwargs):
+    """
+    With RELEASES=True, builds the release of the branch on the host(s) ahead
+    of time, without switching to it. A following deploy then only has to
+    switch over and bounce the services.
+    """
 
-    run_extras()
+    if not bool_opt('releases', kwargs):
+        abort(red("prepare_release needs RELEASES=True"))
 
-    # post fix owners after checkout and other actions
-    fix_ownerships()
+    is_local_clean()
 
-    bounce_services()
+    if bool_opt('artifact', kwargs, default=False):
+        build_artifact(*args, **kwargs)
 
-    update_crontab()
+    with host_state():
+        fleet(prepare_host)(*args, **kwargs)
 
-    print green("Done!")
+    print green("Release ready")
 
 
 @task
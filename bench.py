@@ -0,0 +1,564 @@
+"""
+Benchmarks surge against a local stand-in host, see the README.
+
+The stand-in is a temporary directory with a git origin, the deploy checkout
+and shims for sudo, systemctl, service, pip, manage.py and friends that take
+a configurable while. surge's run/sudo are swapped for an executor running
+the commands locally after sleeping --latency, counting the round-trips, the
+connections opened (HANDSHAKE round-trips each) and the bytes sent and received.
+
+    python -m surge.bench
+    python -m surge.bench --latency 0.1 --set BATCH_REMOTE_COMMANDS=True
+    python -m surge.bench --json bench.jsonl --compare bench.jsonl
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import getpass
+import argparse
+import tempfile
+import importlib
+import subprocess
+import multiprocessing
+from StringIO import StringIO
+from contextlib import contextmanager
+from fabric.api import env, abort, settings
+from fabric.operations import _AttributeString, _prefix_commands
+from fabric.state import output
+
+surge = importlib.import_module(__package__ or 'surge')
+
+## Round-trips it takes to open an ssh connection (TCP, key exchange, auth, channel)
+HANDSHAKE = 4
+
+## The shims on the stand-in's PATH, SURGE_BENCH_* are the seconds they take
+SHIMS = {
+    'sudo': r'''#!/bin/bash
+while [ $# -gt 0 ]; do
+    case "$1" in
+        -u|-p|-g) shift 2;;
+        -*) shift;;
+        *) break;;
+    esac
+done
+exec "$@"
+''',
+    'systemctl': r'''#!/bin/bash
+command=$1; shift
+case "$command" in
+    show)
+        shift 2
+        for unit in "$@"; do
+            printf 'Id=%s.service\nLoadState=loaded\nActiveState=active\nSubState=running\n' $unit
+            printf 'MainPID=%s\nCanReload=yes\nActiveEnterTimestamp=%s\n\n' $$ "$(date)"
+        done;;
+    is-active) ;;
+    *) sleep $SURGE_BENCH_RESTART;;
+esac
+''',
+    'service': r'''#!/bin/bash
+case "$2" in
+    status) echo "$1 start/running, process $$";;
+    *) sleep $SURGE_BENCH_RESTART;;
+esac
+''',
+    'status': r'''#!/bin/bash
+echo "$1 start/running, process $$"
+''',
+    'pip': r'''#!/bin/bash
+if [ -n "$VIRTUAL_ENV" ] && [ ! -d "$VIRTUAL_ENV" ]; then echo "No virtualenv $VIRTUAL_ENV"; exit 1; fi
+sleep $SURGE_BENCH_PIP
+echo "Successfully installed"
+''',
+    'virtualenv': r'''#!/bin/bash
+# Like the real one, activate holds the virtualenv's absolute path
+mkdir -p $1/bin && echo "export VIRTUAL_ENV=$(cd $1 && pwd)" > $1/bin/activate
+''',
+    'nginx': '#!/bin/bash\n',
+    'chown': '#!/bin/bash\n',
+    'crontab': '#!/bin/bash\n',
+}
+
+MANAGE_PY = r'''#!/bin/bash
+# A stand-in for Django's manage.py, the databases remember how many migrations they have
+if [ -n "$VIRTUAL_ENV" ] && [ ! -d "$VIRTUAL_ENV" ]; then echo "No virtualenv $VIRTUAL_ENV"; exit 1; fi
+migrations=$(ls app/migrations/*.py | wc -l)
+database=default
+if [ "$2" = "--database" ]; then database=$3; fi
+case "$1" in
+    diffsettings)
+        echo "SETTINGS_MODULE = 'benchsite.settings'"
+        echo "STATIC_ROOT = '$PWD/collected'";;
+    collectstatic)
+        sleep $SURGE_BENCH_COLLECTSTATIC
+        mkdir -p collected/app && cp app/static/* collected/app/;;
+    migrate)
+        sleep $SURGE_BENCH_MIGRATE
+        echo $migrations > $SURGE_BENCH_DB/$database;;
+    syncdb)
+        sleep $SURGE_BENCH_MIGRATE;;
+    shell)
+        sleep $SURGE_BENCH_BOOT
+        for db in $(sed -n "s/^for db in \[\(.*\)\]:$/\1/p" | tr -d "'," ); do
+            echo "@@pending $db $(( migrations - $(cat $SURGE_BENCH_DB/$db 2>/dev/null || echo 0) ))"
+        done;;
+esac
+'''
+
+PROJECT = {
+    'manage.py': MANAGE_PY,
+    'activate': '',
+    '.gitignore': 'collected/\nvenv/\n',
+    'requirements.txt': 'Django==1.11\n',
+    'crontab.txt': '0 * * * * true\n',
+    'benchsite/__init__.py': '',
+    'benchsite/settings.py': 'STATIC_ROOT = "collected"\n',
+    'app/__init__.py': '',
+    'app/views.py': 'VERSION = 1\n',
+    'app/models.py': '',
+    'app/static/app.js': 'var version = 1;\n',
+    'app/static/style.less': 'body { color: black; }\n',
+    'app/migrations/__init__.py': '',
+    'app/migrations/0001_initial.py': '',
+}
+
+## A git submodule of the project, at lib/
+SUBMODULE = {
+    'README': 'A shared library\n',
+}
+
+## (name, changes committed before it, task and kwargs), run in this order on a fresh stand-in
+SCENARIOS = [
+    ('full_deploy (first)', {}, 'full_deploy', {}),
+    ('full_deploy (unchanged)', {}, 'full_deploy', {}),
+    ('full_deploy (code)', {'app/views.py': 'VERSION = 2\n'}, 'full_deploy', {}),
+    ('full_deploy (static)', {'app/static/app.js': 'var version = 2;\n'}, 'full_deploy', {}),
+    ('full_deploy (migration)', {'app/migrations/0002_more.py': ''}, 'full_deploy', {}),
+    ('full_deploy (requirements)', {'requirements.txt': 'Django==1.11\nsix\n'}, 'full_deploy', {}),
+    ('bounce_services', {}, 'bounce_services', {}),
+    ('services_status', {}, 'services_status', {}),
+    ('collectstatic', {}, 'collectstatic', {'force_collectstatic': True}),
+    ('run_migrations', {}, 'run_migrations', {'force_migrate': True}),
+    ('install_requirements', {}, 'install_requirements', {'force_requirements': True}),
+    ('fix_ownerships', {}, 'fix_ownerships', {}),
+    ('update_crontab', {}, 'update_crontab', {}),
+]
+
+WORK = {
+    'SURGE_BENCH_RESTART': 0.2,
+    'SURGE_BENCH_PIP': 1.0,
+    'SURGE_BENCH_COLLECTSTATIC': 0.5,
+    'SURGE_BENCH_MIGRATE': 0.3,
+    'SURGE_BENCH_BOOT': 0.3,
+}
+
+
+def git(path, *args):
+    subprocess.check_call(('git',) + args, cwd=path, stdout=open(os.devnull, 'w'),
+                          stderr=subprocess.STDOUT, env=git_env())
+
+def git_env():
+    environ = dict(os.environ)
+    environ.update(GIT_AUTHOR_NAME='surge bench', GIT_AUTHOR_EMAIL='bench@localhost',
+                   GIT_COMMITTER_NAME='surge bench', GIT_COMMITTER_EMAIL='bench@localhost',
+                   # The submodule is cloned from a local path, which git no longer allows by default
+                   GIT_CONFIG_COUNT='1', GIT_CONFIG_KEY_0='protocol.file.allow', GIT_CONFIG_VALUE_0='always')
+    return environ
+
+def write_files(path, files):
+    for name, text in files.items():
+        name = os.path.join(path, name)
+        if not os.path.isdir(os.path.dirname(name)):
+            os.makedirs(os.path.dirname(name))
+        with open(name, 'w') as f:
+            f.write(text)
+        if text.startswith('#!'):
+            os.chmod(name, 0o755)
+
+
+class StandIn(object):
+    """
+    A local stand-in host, root is the temporary directory it lives in.
+    Counts the round-trips, connections and bytes of what is run on it in
+    shared memory, so the forked processes of a fleet or of STEP_CONCURRENCY
+    count too.
+
+    Like fabric's, a connection is kept per process. With SSH_MULTIPLEX=True
+    there is one master, kept between scenarios as between fab invocations.
+    """
+    def __init__(self, root, latency, work_scale, releases=False):
+        self.root = root
+        self.latency = latency
+        self.deploy_path = os.path.join(root, 'deploy')
+        self.git_tree = os.path.join(self.deploy_path, 'repo') if releases else self.deploy_path
+        self.round_trips = multiprocessing.Value('l', 0)
+        self.bytes_out = multiprocessing.Value('l', 0)
+        self.bytes_in = multiprocessing.Value('l', 0)
+        self.connections = multiprocessing.Value('l', 0)
+        self.master = multiprocessing.Value('b', 0)
+        self.connected_pids = set()
+
+        self.environ = dict(os.environ)
+        self.environ.update(git_env())
+        self.environ.update(dict((k, str(v * work_scale)) for k, v in WORK.items()))
+        self.environ.update({
+            # Nothing of the local PATH, ie. another activate for 'source activate' to find
+            'PATH': os.path.join(root, 'bin') + ':/usr/local/bin:/usr/bin:/bin',
+            'HOME': os.path.join(root, 'home'),
+            'SUDO_USER': getpass.getuser(),
+            'SURGE_BENCH_DB': os.path.join(root, 'db'),
+        })
+
+        write_files(os.path.join(root, 'bin'), SHIMS)
+        for name in ('home', 'db', 'logs'):
+            os.makedirs(os.path.join(root, name))
+        lib = os.path.join(root, 'lib')
+        write_files(lib, SUBMODULE)
+        git(lib, 'init', '-q')
+        git(lib, 'add', '-A')
+        git(lib, 'commit', '-q', '-m', 'Initial')
+        work = os.path.join(root, 'work')
+        write_files(work, PROJECT)
+        git(root, 'init', '-q', '--bare', 'origin.git')
+        git(work, 'init', '-q')
+        git(work, 'submodule', '-q', 'add', lib, 'lib')
+        git(work, 'add', '-A')
+        git(work, 'commit', '-q', '-m', 'Initial')
+        git(work, 'push', '-q', os.path.join(root, 'origin.git'), 'HEAD:refs/heads/master')
+        os.makedirs(self.deploy_path)
+        git(root, 'clone', '-q', '-b', 'master', os.path.join(root, 'origin.git'), self.git_tree)
+
+    def commit(self, files):
+        work = os.path.join(self.root, 'work')
+        write_files(work, files)
+        git(work, 'add', '-A')
+        git(work, 'commit', '-q', '-m', 'Change')
+        git(work, 'push', '-q', os.path.join(self.root, 'origin.git'), 'HEAD:refs/heads/master')
+
+    def count(self, sent, received):
+        with self.round_trips.get_lock():
+            self.round_trips.value += 1
+        with self.bytes_out.get_lock():
+            self.bytes_out.value += sent
+        with self.bytes_in.get_lock():
+            self.bytes_in.value += received
+
+    def counters(self):
+        return self.round_trips.value, self.bytes_out.value, self.bytes_in.value, self.connections.value
+
+    def ssh_connected(self):
+        if surge.bool_opt('ssh_multiplex', {}):
+            return bool(self.master.value)
+        return os.getpid() in self.connected_pids
+
+    def ssh_connect(self):
+        time.sleep(self.latency * HANDSHAKE)
+        with self.connections.get_lock():
+            self.connections.value += 1
+        if surge.bool_opt('ssh_multiplex', {}):
+            self.master.value = 1
+        self.connected_pids.add(os.getpid())
+
+    def disconnect(self):
+        """
+        Drops fabric's connection, as the end of a fab invocation does
+        """
+        self.connected_pids.clear()
+
+    def execute(self, command, which='run', quiet=False, warn_only=False, **kwargs):
+        """
+        What Fabric's run/sudo do, on the stand-in after a round-trip's latency
+        """
+        time.sleep(self.latency)
+        real_command = _prefix_commands(command, 'remote')
+        process = subprocess.Popen(['/bin/bash', '-c', real_command], cwd=os.path.join(self.root, 'home'),
+                                   env=self.environ, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = process.communicate()[0]
+        self.count(len(real_command), len(out))
+
+        if not quiet and output.running:
+            print "[{0}] {1}: {2}".format(env.host_string, which, command)
+        if not quiet and output.stdout:
+            for line in out.splitlines():
+                print "[{0}] out: {1}".format(env.host_string, line)
+
+        result = _AttributeString(out.rstrip('\n'))
+        result.command = command
+        result.real_command = real_command
+        result.return_code = process.returncode
+        result.failed = process.returncode != 0
+        result.succeeded = not result.failed
+        result.stderr = ''
+        if result.failed and not (quiet or warn_only or env.warn_only):
+            abort("{0}() received nonzero return code {1} while executing!\n\nRequested: {2}\n\n{3}".format(
+                which, process.returncode, command, out))
+        return result
+
+    def run(self, command, **kwargs):
+        return self.execute(command, 'run', **kwargs)
+
+    def sudo(self, command, **kwargs):
+        return self.execute(command, 'sudo', **kwargs)
+
+    def ssh_run(self, command, use_sudo=False, **kwargs):
+        return self.execute(command, 'sudo' if use_sudo else 'run', **kwargs)
+
+    def rsync_project(self, remote_dir, local_dir=None, exclude=(), delete=False, extra_opts='', **kwargs):
+        time.sleep(self.latency)
+        out = subprocess.check_output('mkdir -p {0} && rsync -a --stats {1} {2} {3} {4}'.format(
+            remote_dir, '--delete' if delete else '', extra_opts, local_dir, remote_dir), shell=True)
+        sent = re.search(r'Total bytes sent: ([\d,]+)', out)
+        received = re.search(r'Total bytes received: ([\d,]+)', out)
+        self.count(int(sent.group(1).replace(',', '')) if sent else 0,
+                   int(received.group(1).replace(',', '')) if received else 0)
+        return out
+
+    def rsync_from_host(self, remote_dir, local_dir, extra_opts=()):
+        time.sleep(self.latency)
+        out = subprocess.check_output(['rsync', '-rlpt', '--delete', '--stats'] + list(extra_opts) +
+                                      [remote_dir, local_dir])
+        sent = re.search(r'Total bytes sent: ([\d,]+)', out)
+        received = re.search(r'Total bytes received: ([\d,]+)', out)
+        self.count(int(received.group(1).replace(',', '')) if received else 0,
+                   int(sent.group(1).replace(',', '')) if sent else 0)
+        return out
+
+@contextmanager
+def stand_in(host):
+    """
+    Points surge's remote calls at the stand-in host for the duration
+    """
+    patched = ('run', 'sudo', 'ssh_run', 'ssh_connected', 'ssh_connect', 'rsync_project', 'rsync_from_host')
+    originals = dict((name, getattr(surge, name)) for name in patched)
+    for name in patched:
+        setattr(surge, name, getattr(host, name))
+    try:
+        with settings(host_string='standin', shell='/bin/bash -c'):
+            yield
+    finally:
+        for name, f in originals.items():
+            setattr(surge, name, f)
+
+@contextmanager
+def captured(verbose):
+    """
+    Swallows the output of the wrapped block (unless verbose), handing it back
+    in the list yielded.
+    """
+    captured = []
+    if verbose:
+        yield captured
+        return
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = StringIO()
+    try:
+        yield captured
+    finally:
+        captured.append(sys.stdout.getvalue())
+        sys.stdout, sys.stderr = stdout, stderr
+
+@contextmanager
+def http_stand_in(delays=None, errors=None):
+    """
+    Serves HTTP on a local port, yielded, for CANARY_URL benchmarks: requests
+    for a hostname in delays take that many seconds, and that fraction of those
+    for a hostname in errors fail with a 500, so http://localhost:<port>/ and
+    http://127.0.0.1:<port>/ can stand in for a canary and its baseline.
+    """
+    import random
+    import threading
+    import BaseHTTPServer
+    import SocketServer
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def do_GET(self):
+            hostname = (self.headers.get('Host') or '').split(':')[0]
+            time.sleep((delays or {}).get(hostname, 0))
+            status = 500 if random.random() < (errors or {}).get(hostname, 0) else 200
+            self.send_response(status)
+            self.send_header('Content-Length', '3')
+            self.end_headers()
+            self.wfile.write('ok\n')
+
+        def log_message(self, *args):
+            pass
+
+    class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+        daemon_threads = True
+        request_queue_size = 64
+
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def deploy_settings(host, overrides):
+    values = dict(
+        HOST='standin',
+        USER=getpass.getuser(),
+        GROUP=getpass.getuser(),
+        DEPLOY_PATH=host.deploy_path,
+        REQUIRE_CLEAN=False,
+        SHOW_TIMINGS=False,
+        OS_SERVICE_MANAGER='systemd',
+        BOUNCE_SERVICES=['web', 'worker', 'celery'],
+        CRON_FILE=os.path.join(host.deploy_path, 'current' if host.git_tree != host.deploy_path else '',
+                               'crontab.txt'),
+        LOGS_PATH=os.path.join(host.root, 'logs'),
+        EXTRA_COMMANDS=['echo extra'],
+        RELEASE_VENV_COMMAND='virtualenv venv && ln -sfn venv/bin/activate activate',
+        LOCAL_WHEELHOUSE=os.path.join(host.root, 'wheelhouse'),
+        LOCAL_ARTIFACTS=os.path.join(host.root, 'artifacts'),
+    )
+    values.update(overrides)
+    return surge.BASE_SETTINGS(**values)
+
+def run_scenarios(names, overrides, latency, work_scale, verbose):
+    """
+    Runs the scenarios on a fresh stand-in, returns {scenario: measurement}
+    """
+    root = tempfile.mkdtemp(prefix='surge-bench-')
+    results = {}
+    try:
+        host = StandIn(root, latency, work_scale,
+                       releases=str(overrides.get('RELEASES', False)).lower() in ('true', '1'))
+        for name, changes, task, kwargs in SCENARIOS:
+            if changes:
+                host.commit(changes)
+            if name not in names:
+                continue
+
+            env.deploy_settings = deploy_settings(host, overrides)
+            env['surge_stack'] = None
+            host.disconnect()
+            before = host.counters()
+            started = time.time()
+            status = 'ok'
+            with stand_in(host):
+                with captured(verbose) as out:
+                    try:
+                        getattr(surge, task)(**kwargs)
+                    except SystemExit as e:
+                        status = 'failed'
+                        error = getattr(e, 'message', '') or repr(e)
+            elapsed = time.time() - started
+            if status != 'ok' and out:
+                print out[0][-3000:]
+                print "{0} failed: {1}".format(name, error)
+            after = host.counters()
+            results[name] = {
+                'status': status,
+                'wall': elapsed,
+                'round_trips': after[0] - before[0],
+                'bytes_out': after[1] - before[1],
+                'bytes_in': after[2] - before[2],
+                'connections': after[3] - before[3],
+            }
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+def surge_version():
+    path = os.path.dirname(os.path.abspath(surge.__file__))
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=path,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (subprocess.CalledProcessError, OSError):
+        return 'unknown'
+
+def recorded(path, key):
+    """
+    The last recorded measurement of each scenario in the JSON lines file, of
+    runs with the same key (latency, work scale and settings)
+    """
+    last = {}
+    if path and os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('key') == key:
+                    last[entry['scenario']] = entry
+    return last
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark surge against a local stand-in host")
+    parser.add_argument('scenarios', nargs='*', help="the scenarios to run (default all): " +
+                        ', '.join(s[0] for s in SCENARIOS))
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds per round-trip (0.05)")
+    parser.add_argument('--work-scale', type=float, default=1.0,
+                        help="scales how long pip, collectstatic, migrate and restarts take (1.0)")
+    parser.add_argument('--repeat', type=int, default=1, help="runs to take the median wall time of")
+    parser.add_argument('--set', action='append', default=[], metavar='SETTING=VALUE',
+                        help="a deploy setting to benchmark with, ie. BATCH_REMOTE_COMMANDS=True")
+    parser.add_argument('--json', help="append the measurements to this JSON lines file")
+    parser.add_argument('--compare', help="compare against the last measurements in this JSON lines file "
+                        "and exit 1 on a regression")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="how much slower the wall time may get before it counts as a regression (0.2)")
+    parser.add_argument('--verbose', action='store_true', help="show the deploy output")
+    options = parser.parse_args(argv)
+
+    overrides = dict(s.split('=', 1) for s in options.set)
+    names = options.scenarios or [s[0] for s in SCENARIOS]
+    unknown = set(names) - set(s[0] for s in SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: {0}".format(', '.join(sorted(unknown))))
+
+    runs = [run_scenarios(names, overrides, options.latency, options.work_scale, options.verbose)
+            for _ in range(max(options.repeat, 1))]
+
+    key = json.dumps([options.latency, options.work_scale, sorted(overrides.items())])
+    baseline = recorded(options.compare, key)
+    version = surge_version()
+    regressions = []
+
+    print "surge {0}, {1}s per round-trip{2}".format(
+        version, options.latency, ', ' + ' '.join(options.set) if options.set else '')
+    print "{0:<28} {1:>8} {2:>12} {3:>11} {4:>10} {5:>10}  {6}".format(
+        'scenario', 'wall', 'round-trips', 'connections', 'sent', 'received', 'status')
+    entries = []
+    for name in names:
+        walls = sorted(run[name]['wall'] for run in runs)
+        result = dict(runs[-1][name], wall=walls[len(walls) / 2])
+        compared = ''
+        previous = baseline.get(name)
+        if previous:
+            compared = "{0:+.2f}s {1:+d} round-trips vs {2}".format(
+                result['wall'] - previous['wall'], result['round_trips'] - previous['round_trips'],
+                previous['version'])
+            # A little slack for the noise of the shortest scenarios
+            if result['round_trips'] > previous['round_trips'] or \
+               result['wall'] > previous['wall'] * (1 + options.tolerance) + 0.1:
+                regressions.append(name)
+        print "{0:<28} {1:>7.2f}s {2:>12} {3:>11} {4:>10} {5:>10}  {6} {7}".format(
+            name, result['wall'], result['round_trips'], result['connections'], result['bytes_out'],
+            result['bytes_in'], result['status'], compared)
+        entries.append(dict(result, scenario=name, version=version, key=key,
+                            recorded_at=time.strftime('%Y-%m-%dT%H:%M:%S')))
+
+    if options.json:
+        with open(options.json, 'a') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+
+    failed = [e['scenario'] for e in entries if e['status'] != 'ok']
+    if regressions:
+        print "Regressions: {0}".format(', '.join(regressions))
+    if failed:
+        print "Failed: {0}".format(', '.join(failed))
+    return 1 if regressions or failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())